@@ -0,0 +1,273 @@
+# Benchmark suite for the allocator, schedulers, batch allocator and Banker's algorithm
+# Workloads are synthetic and seeded, so runs are reproducible. Console output
+# from the engine is silenced. Results (wall time, ops/sec, peak memory) are
+# written to a JSON file and can be compared against a saved baseline:
+#   python benchmark.py --sizes 10,1000,100000 -o results.json
+#   python benchmark.py -o new.json --baseline results.json
+#   python benchmark.py --footprint 10000000 -o footprint.json
+#   python benchmark.py --sites 1,2,4 --sizes 100000 -o sharded.json
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+from blood_bank_1 import (ID_BITS, BankersAlgorithm, BlockTable, BloodInventory, MemoryManager, Scheduler,
+                          ShardRouter, set_quiet)
+
+BLOOD_TYPES = ['A+', 'A-', 'B+', 'B-', 'AB+', 'AB-', 'O+', 'O-']
+# Skewed roughly like donor populations: O+ and A+ dominate, AB- is rare
+TYPE_WEIGHTS = [34, 6, 9, 2, 3, 1, 38, 7]
+# Most requests are routine, a few are urgent
+PRIORITY_WEIGHTS = [20, 18, 15, 12, 10, 8, 7, 5, 3, 2]
+
+# Workload generators
+def blood_types(rng, n):
+    return rng.choices(BLOOD_TYPES, weights=TYPE_WEIGHTS, k=n)
+
+def make_requests(rng, n, max_units=20):
+    types = blood_types(rng, n)
+    priorities = rng.choices(range(1, 11), weights=PRIORITY_WEIGHTS, k=n)
+    return [{'id': i + 1, 'blood_type': bt, 'units': rng.randint(1, max_units), 'priority': p}
+            for i, (bt, p) in enumerate(zip(types, priorities))]
+
+def make_donations(rng, n, max_units=20):
+    return [(bt, rng.randint(1, max_units)) for bt in blood_types(rng, n)]
+
+def stocked_scheduler(rng, requests, coverage=0.8, **scheduler_args):
+    # Stock covers `coverage` of the demand per type, so some requests block
+    demand = dict.fromkeys(BLOOD_TYPES, 0)
+    for req in requests:
+        demand[req['blood_type']] += req['units']
+    inventory = BloodInventory(MemoryManager(sum(demand.values()) + 1))
+    for bt, units in demand.items():
+        if int(units * coverage) > 0:
+            inventory.donate_blood(bt, int(units * coverage))
+    scheduler = Scheduler(inventory, **scheduler_args)
+    for req in requests:
+        scheduler.requests.append(req)
+    return scheduler
+
+# Benchmarks: each takes (rng, size), prepares its state, and returns
+# (callable to time, number of operations it performs)
+def bench_allocator(rng, size):
+    donations = make_donations(rng, size)
+    memory_manager = MemoryManager(sum(units for _, units in donations))
+
+    def run():
+        blocks = [memory_manager.allocate_block(bt, units) for bt, units in donations]
+        # Free every other block, then dispense by type, to exercise coalescing
+        for block_id in blocks[::2]:
+            memory_manager.free_block(block_id)
+        for bt, units in donations[1::2]:
+            memory_manager.deallocate_memory(bt, units)
+    return run, size * 2
+
+def bench_round_robin(rng, size):
+    scheduler = stocked_scheduler(rng, make_requests(rng, size))
+    return scheduler.process_round_robin, size
+
+def bench_priority(rng, size):
+    scheduler = stocked_scheduler(rng, make_requests(rng, size), aging_rate=0.001)
+    return scheduler.process_priority, size
+
+def bench_batch(rng, size):
+    scheduler = stocked_scheduler(rng, make_requests(rng, size))
+    return scheduler.process_batch, size
+
+def bench_bankers(rng, size):
+    requests = make_requests(rng, size)
+    total = [sum(req['units'] for req in requests if req['blood_type'] == bt) for bt in BLOOD_TYPES]
+
+    def run():
+        BankersAlgorithm.from_requests(total, BLOOD_TYPES, requests).is_safe()
+    return run, size
+
+BENCHMARKS = {
+    'allocator': bench_allocator,
+    'round_robin': bench_round_robin,
+    'priority': bench_priority,
+    'batch': bench_batch,
+    'bankers': bench_bankers,
+}
+
+def measure(name, size, seed, repeat, track_memory):
+    # Best of `repeat` runs, each on freshly generated state
+    bench = BENCHMARKS[name]
+    seconds = float('inf')
+    for _ in range(repeat):
+        run, ops = bench(random.Random(seed), size)
+        gc.collect()
+        gc.disable()  # As timeit does, keep collector pauses out of the timing
+        try:
+            start = time.perf_counter()
+            run()
+            seconds = min(seconds, time.perf_counter() - start)
+        finally:
+            gc.enable()
+    result = {'name': name, 'size': size, 'seconds': seconds, 'ops': ops,
+              'ops_per_sec': ops / seconds if seconds else float('inf')}
+    if track_memory:
+        # Separate run, since tracemalloc slows the timed one down
+        tracemalloc.start()
+        run, _ = bench(random.Random(seed), size)
+        tracemalloc.reset_peak()
+        run()
+        result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+# Memory footprint of the block table: the old layout (one six-key dict with
+# two datetimes per block) against the BlockTable columns plus the per-type
+# heap entries. Building millions of dicts is slow and memory hungry, so the
+# old layout is measured on `sample` blocks and scaled linearly.
+def traced_bytes(build, n):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build(n)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    return used
+
+def build_dict_blocks(n):
+    return [{
+        'id': i,
+        'size': 100,
+        'used': 10,
+        'blood_type': BLOOD_TYPES[i % 8],
+        'entry_date': datetime.now(),
+        'expiry_date': datetime.now(),
+    } for i in range(n)]
+
+def build_block_table(n):
+    table = BlockTable()
+    for i in range(n):
+        table.add(i * 10, 10, i % 8, 1700000000 + i, 1702592000 + i)
+    return table
+
+def build_block_index(n):
+    # Heap entries as the allocator stores them, spread over eight types
+    heaps = [[] for _ in range(8)]
+    for i in range(n):
+        heaps[i % 8].append((1702592000 + i) << ID_BITS | i)
+    return heaps
+
+def footprint(blocks, sample):
+    sample = min(sample, blocks)
+    dict_bytes = traced_bytes(build_dict_blocks, sample) * blocks / sample
+    table_bytes = traced_bytes(build_block_table, blocks)
+    index_bytes = traced_bytes(build_block_index, blocks)
+    result = {
+        'blocks': blocks,
+        'dict_layout_bytes': dict_bytes,
+        'block_table_bytes': table_bytes,
+        'block_index_bytes': index_bytes,
+        'reduction': dict_bytes / table_bytes,
+    }
+    print(f"Block table footprint at {blocks:,} blocks (dict layout scaled from {sample:,}):")
+    print(f"  dict layout      {dict_bytes / 2 ** 20:10.1f} MiB  ({dict_bytes / blocks:6.1f} B/block)")
+    print(f"  block table      {table_bytes / 2 ** 20:10.1f} MiB  ({table_bytes / blocks:6.1f} B/block)  {result['reduction']:.1f}x smaller")
+    print(f"  + expiry index   {index_bytes / 2 ** 20:10.1f} MiB  ({index_bytes / blocks:6.1f} B/block)")
+    return result
+
+# Sharded throughput: the same seeded donations and requests spread round
+# robin over 1, 2, 4, ... site processes. Process startup is not timed.
+def sharded(size, site_counts, seed):
+    results = []
+    for count in site_counts:
+        rng = random.Random(seed)
+        requests = make_requests(rng, size)
+        donations = make_donations(rng, size)
+        router = ShardRouter([f"site{i}" for i in range(count)], total_capacity=sum(u for _, u in donations) + 1)
+        try:
+            start = time.perf_counter()
+            for i, (bt, units) in enumerate(donations):
+                router.donate(router.sites[i % count], bt, units)
+            for i, request in enumerate(requests):
+                router.add_request(router.sites[i % count], request)
+            outcome = router.process()
+            seconds = time.perf_counter() - start
+        finally:
+            router.close()
+        result = {'name': 'sharded', 'size': size, 'sites': count, 'seconds': seconds, 'ops': size * 2,
+                  'ops_per_sec': size * 2 / seconds,
+                  'served': sum(site['processed'] for site in outcome['sites'].values()),
+                  'transfers': len(outcome['transfers'])}
+        results.append(result)
+        print(f"sharded {size:>9}  {count:>3} sites  {seconds:9.4f}s  {result['ops_per_sec']:>14,.0f} ops/s  "
+              f"{result['served']} served, {result['transfers']} transfers")
+    return results
+
+def compare(results, baseline, threshold):
+    # Flags benchmarks whose throughput fell more than `threshold` below
+    # baseline. Sharded runs are also keyed by their site count.
+    previous = {(r['name'], r['size'], r.get('sites')): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        old = previous.get((result['name'], result['size'], result.get('sites')))
+        if old is None:
+            continue
+        change = result['ops_per_sec'] / old['ops_per_sec'] - 1
+        result['change'] = change
+        if change < -threshold:
+            regressions.append(result)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the blood bank engine")
+    parser.add_argument('--sizes', default='10,1000,100000', help="Comma-separated queue/workload sizes")
+    parser.add_argument('--only', default=','.join(BENCHMARKS), help="Comma-separated benchmarks to run")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per benchmark; the best is kept")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the peak-memory pass")
+    parser.add_argument('-o', '--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help="Results file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Allowed ops/sec drop before flagging (0.2 = 20%%)")
+    parser.add_argument('--footprint', type=int, metavar='BLOCKS', help="Only measure the block table footprint at this many blocks")
+    parser.add_argument('--sites', help="Only measure sharded throughput at these comma-separated site counts")
+    parser.add_argument('--footprint-sample', type=int, default=1000000, help="Blocks actually built for the dict layout")
+    args = parser.parse_args(argv)
+
+    if args.footprint:
+        result = footprint(args.footprint, args.footprint_sample)
+        with open(args.output, 'w') as file:
+            json.dump({'meta': {'timestamp': datetime.now().isoformat(), 'python': platform.python_version()},
+                       'footprint': result}, file, indent=2)
+        return 0
+
+    set_quiet(True)
+    sizes = [int(s) for s in args.sizes.split(',')]
+    results = []
+    if args.sites:
+        for size in sizes:
+            results.extend(sharded(size, [int(c) for c in args.sites.split(',')], args.seed))
+    for name in ([] if args.sites else args.only.split(',')):
+        for size in sizes:
+            result = measure(name, size, args.seed, args.repeat, not args.no_memory)
+            results.append(result)
+            peak = f"{result['peak_bytes'] / 2 ** 20:9.1f} MiB" if 'peak_bytes' in result else ""
+            print(f"{name:<12} {size:>9}  {result['seconds']:9.4f}s  {result['ops_per_sec']:>14,.0f} ops/s  {peak}")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for result in regressions:
+            sites = f" sites {result['sites']}" if 'sites' in result else ""
+            print(f"REGRESSION {result['name']} size {result['size']}{sites}: {result['change']:+.1%} ops/s")
+
+    with open(args.output, 'w') as file:
+        json.dump({
+            'meta': {'timestamp': datetime.now().isoformat(), 'seed': args.seed,
+                     'python': platform.python_version(), 'platform': platform.platform()},
+            'results': results,
+        }, file, indent=2)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
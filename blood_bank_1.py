@@ -1,136 +1,1177 @@
+from array import array
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
 from colorama import init, Fore, Style
+import argparse
+import asyncio
+import atexit
+import bisect
+import csv
 import hashlib
+import heapq
+import hmac
+import itertools
+import mmap
 import os
+import sqlite3
+import sys
+import threading
 import time
 import json
+import multiprocessing
+import zlib
 from tabulate import tabulate
+import numpy as np
 
 # Initialize colorama
 init()
 
 # Helper functions
 def clear_screen():
-    os.system('cls' if os.name == 'nt' else 'clear')
+    # ANSI clear and home; colorama translates it on Windows consoles
+    print("\033[2J\033[H", end="", flush=True)
+
+# Output sinks
+# The engine reports what happened as events, emit(kind, **fields), and the
+# current sink decides what reaches a terminal or a file:
+#   NullSink     drops everything (headless runs, benchmarks)
+#   ConsoleSink  renders events with colorama; a scheduler run is buffered
+#                and printed once, as one table, when it ends
+#   JsonlSink    writes one JSON object per event
+# Event kinds: donate, request, queued, run_start, slice (one Round Robin
+# time slice) and run_end.
+class NullSink:
+    def emit(self, event):
+        pass
+
+    def close(self):
+        pass
+
+class ConsoleSink:
+    def __init__(self, max_rows=20, file=None):
+        self.max_rows = max_rows
+        self.file = file
+        self.run = None  # run_start of the scheduler run being buffered
+        self.slices = []  # first max_rows slices of that run
+        self.slice_count = 0
+
+    def emit(self, event):
+        kind = event['kind']
+        if kind == 'run_start':
+            self.run, self.slices, self.slice_count = event, [], 0
+        elif kind == 'run_end':
+            start, self.run = self.run, None
+            self.write(self.render_run(start, event))
+            self.slices, self.slice_count = [], 0
+        elif self.run is not None:
+            # Only the table rows and a count are kept; the per-request
+            # events a run emits are not shown in its summary
+            if kind == 'slice':
+                self.slice_count += 1
+                if len(self.slices) < self.max_rows:
+                    self.slices.append(event)
+        else:
+            self.write([self.render(event)])
+
+    def write(self, lines):
+        print('\n'.join(lines), file=self.file or sys.stdout)
+
+    def render(self, event):
+        kind, reason = event['kind'], event.get('reason')
+        if reason == 'invalid_type':
+            return Fore.RED + "❌ Invalid blood type!" + Style.RESET_ALL
+        if reason == 'invalid_units':
+            return Fore.RED + "❌ Units must be positive!" + Style.RESET_ALL
+        if reason == 'expired':
+            return Fore.RED + "❌ Blood is already past its expiry date!" + Style.RESET_ALL
+        if kind == 'donate':
+            if event['ok']:
+                return Fore.GREEN + f"✅ Success! {event['units']} units of {event['blood_type']} added to stock (Expiry: {event['expiry']})." + Style.RESET_ALL
+            return Fore.RED + "❌ Storage capacity full!" + Style.RESET_ALL
+        if kind == 'request':
+            if event['ok'] and event.get('drawn'):
+                sources = ', '.join(f"{bt}: {take}" for bt, take in event['drawn'].items())
+                return Fore.GREEN + f"✅ Success! {event['units']} units for {event['blood_type']} dispensed ({sources})." + Style.RESET_ALL
+            if event['ok']:
+                return Fore.GREEN + f"✅ Success! {event['units']} units of {event['blood_type']} dispensed." + Style.RESET_ALL
+            if reason == 'deallocation_failed':
+                return Fore.RED + "❌ Memory deallocation failed!" + Style.RESET_ALL
+            return Fore.RED + f"❌ Insufficient stock for {event['blood_type']}! Available: {event['available']} units" + Style.RESET_ALL
+        if kind == 'queued':
+            return Fore.GREEN + f"✅ Request {event['id']} for {event['blood_type']} ({event['units']} units, Priority: {event['priority']}) added." + Style.RESET_ALL
+        return str(event)
+
+    def render_run(self, start, end):
+        start = start or {'policy': end['policy']}
+        titles = {'round_robin': f"Round Robin, Time Quantum: {start.get('time_quantum')}s",
+                  'priority': "Priority", 'batch': "Batch, compatibility-aware"}
+        lines = [Fore.CYAN + f"\nProcessing Requests ({titles.get(end['policy'], end['policy'])}):" + Style.RESET_ALL]
+        if not end['processed'] and not end['blocked']:
+            return lines + [Fore.YELLOW + "No requests to process." + Style.RESET_ALL]
+        if self.slices:
+            rows = [[e['time'], e['id'], e['blood_type'], f"{e['units']}/{e['requested']}", "✅" if e['ok'] else "❌"]
+                    for e in self.slices]
+            lines.append(tabulate(rows, headers=["Time (s)", "Request ID", "Blood Type", "Units", "Served"], tablefmt="grid"))
+            shown = self.slice_count
+        else:
+            rows = [list(entry) for entry in end['processed'][:self.max_rows]]
+            if rows:
+                lines.append(tabulate(rows, headers=["Request ID", "Units", "Blood Type"], tablefmt="grid"))
+            shown = len(end['processed'])
+        if shown > len(rows):
+            lines.append(f"... and {shown - len(rows)} more")
+        lines.append(f"Processed: {len(end['processed'])}")
+        if end.get('substitutions'):
+            lines.append(f"Substitutions: {end['substitutions']}")
+        if end['status'] == 'blocked' and end['policy'] == 'round_robin':
+            lines.append(Fore.RED + f"❌ Stopped: {len(end['blocked'])} request(s) blocked by insufficient stock." + Style.RESET_ALL)
+        elif end['status'] == 'blocked':
+            ids = [req['id'] for req in end['blocked'][:self.max_rows]]
+            more = f" ... (+{len(end['blocked']) - len(ids)} more)" if len(end['blocked']) > len(ids) else ""
+            lines.append(Fore.RED + f"❌ {len(end['blocked'])} request(s) kept in queue due to insufficient stock: {ids}{more}" + Style.RESET_ALL)
+        elif end['status'] == 'budget_exhausted':
+            lines.append(Fore.YELLOW + "Stopped: iteration budget exhausted." + Style.RESET_ALL)
+        return lines
+
+    def close(self):
+        pass
+
+class JsonlSink:
+    def __init__(self, path):
+        self.file = open(path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def emit(self, event):
+        line = json.dumps(event, default=str) + '\n'
+        with self.lock:
+            self.file.write(line)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+SINK = ConsoleSink()
+
+def set_sink(sink):
+    global SINK
+    previous, SINK = SINK, sink
+    return previous
+
+def emit(kind, **fields):
+    SINK.emit({'kind': kind, **fields})
+
+@contextmanager
+def use_sink(sink):
+    previous = set_sink(sink)
+    try:
+        yield sink
+    finally:
+        set_sink(previous)
+
+def set_quiet(quiet=True):
+    set_sink(NullSink() if quiet else ConsoleSink())
+
+def quiet():
+    return use_sink(NullSink())
 
 def print_banner():
     print(Fore.RED + Style.BRIGHT + "*** Blood Bank Management System ***" + Style.RESET_ALL)
 
 def loading_animation():
-    for _ in range(3):
-        print(Fore.YELLOW + ".", end="", flush=True)
-        time.sleep(0.5)
-    print(Style.RESET_ALL)
+    print(Fore.YELLOW + "..." + Style.RESET_ALL)
 
-# Donor class
-class Donor:
-    def __init__(self):
-        self.donors = {}
-        self.load_donors()
+# Password hashing
+# New hashes use salted scrypt (memory-hard) encoded as
+# scrypt$n$r$p$salt$hash; bare 64-char hex digests are legacy unsalted SHA-256.
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2 ** 14, 8, 1
+
+def hash_password(password):
+    salt = os.urandom(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+def verify_password(password, stored_hash):
+    if stored_hash.startswith('scrypt$'):
+        _, n, r, p, salt, digest = stored_hash.split('$')
+        candidate = hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), n=int(n), r=int(r), p=int(p))
+        return hmac.compare_digest(candidate.hex(), digest)
+    return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored_hash)
+
+def read_donor_records(path):
+    # Yields (line number, username, password, error) from a CSV file with
+    # username,password columns or from JSON lines
+    with open(path, 'r', newline='') as file:
+        if path.lower().endswith('.csv'):
+            for line_no, row in enumerate(csv.DictReader(file), start=2):
+                yield line_no, (row.get('username') or '').strip(), row.get('password') or '', None
+        else:
+            for line_no, line in enumerate(file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    yield line_no, str(record.get('username') or '').strip(), str(record.get('password') or ''), None
+                except (ValueError, AttributeError) as e:
+                    yield line_no, None, None, f"invalid record: {e}"
+
+# Donor storage class
+# SQLite-backed donor store: one row per donor keyed (and indexed) by
+# username. Writes are committed every batch_size inserts or on commit().
+# On first open, donors from the legacy donors.json file are migrated once.
+# Any object with the same methods can be passed to Donor as its store.
+class SQLiteDonorStore:
+    def __init__(self, path='donors.db', batch_size=1, legacy_json='donors.json'):
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS donors (username TEXT PRIMARY KEY, password_hash TEXT NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.commit()
+        self.batch_size = batch_size
+        self.pending = 0
+        if legacy_json:
+            self.migrate_json(legacy_json)
 
-    def load_donors(self):
+    def migrate_json(self, path):
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_json'").fetchone():
+            return 0
         try:
-            with open('donors.json', 'r') as file:
-                self.donors = json.load(file)
+            with open(path, 'r') as file:
+                donors = json.load(file)
         except FileNotFoundError:
-            self.donors = {}
+            donors = {}
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO donors VALUES (?, ?)', donors.items())
+            self.conn.execute("INSERT INTO meta VALUES ('migrated_json', ?)", (datetime.now().isoformat(),))
+        return len(donors)
+
+    def __contains__(self, username):
+        return self.conn.execute('SELECT 1 FROM donors WHERE username = ?', (username,)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM donors').fetchone()[0]
+
+    def get(self, username):
+        row = self.conn.execute('SELECT password_hash FROM donors WHERE username = ?', (username,)).fetchone()
+        return row[0] if row else None
 
-    def save_donors(self):
-        with open('donors.json', 'w') as file:
-            json.dump(self.donors, file)
+    def existing(self, usernames):
+        usernames = list(usernames)
+        found = set()
+        for i in range(0, len(usernames), 500):
+            chunk = usernames[i:i + 500]
+            query = f"SELECT username FROM donors WHERE username IN ({','.join('?' * len(chunk))})"
+            found.update(row[0] for row in self.conn.execute(query, chunk))
+        return found
+
+    def add(self, username, password_hash):
+        try:
+            self.conn.execute('INSERT INTO donors VALUES (?, ?)', (username, password_hash))
+        except sqlite3.IntegrityError:
+            return False
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.commit()
+        return True
+
+    def add_many(self, rows):
+        # Inserts a batch in one transaction; returns how many were new
+        before = self.conn.total_changes
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO donors VALUES (?, ?)', rows)
+        self.pending = 0
+        return self.conn.total_changes - before
+
+    def commit(self):
+        self.conn.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+# Donor class
+class Donor:
+    def __init__(self, store=None):
+        self.store = store if store is not None else SQLiteDonorStore()
 
     def register(self, username, password):
-        if username in self.donors:
+        if username in self.store:
+            print(Fore.RED + "❌ Username already exists!" + Style.RESET_ALL)
+            return False
+        if not self.store.add(username, hash_password(password)):
             print(Fore.RED + "❌ Username already exists!" + Style.RESET_ALL)
             return False
-        hashed_password = hashlib.sha256(password.encode()).hexdigest()
-        self.donors[username] = hashed_password
-        self.save_donors()
         print(Fore.GREEN + f"✅ Donor {username} registered successfully!" + Style.RESET_ALL)
         return True
 
+    def authenticate(self, username, password):
+        stored_hash = self.store.get(username)
+        return stored_hash is not None and verify_password(password, stored_hash)
+
+    def bulk_import(self, path, workers=None, batch_size=1000):
+        # Streams donors from a CSV/JSONL file. Each batch is deduplicated
+        # against the store and earlier rows, hashed on a process pool, and
+        # written in one transaction.
+        report = {'read': 0, 'imported': 0, 'duplicates': 0, 'errors': []}
+        seen = set()
+        start = time.perf_counter()
+
+        def flush(batch):
+            usernames = [username for _, username, _ in batch]
+            existing = self.store.existing(usernames)
+            fresh = []
+            for line_no, username, password in batch:
+                if username in existing or username in seen:
+                    report['duplicates'] += 1
+                    report['errors'].append((line_no, f"duplicate username {username!r}"))
+                else:
+                    seen.add(username)
+                    fresh.append((username, password))
+            chunksize = max(1, len(fresh) // ((workers or os.cpu_count() or 1) * 4))
+            hashes = pool.map(hash_password, [password for _, password in fresh], chunksize=chunksize)
+            report['imported'] += self.store.add_many(zip([username for username, _ in fresh], hashes))
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            batch = []
+            for line_no, username, password, error in read_donor_records(path):
+                report['read'] += 1
+                if error is None and (not username or not password):
+                    error = "missing username or password"
+                if error:
+                    report['errors'].append((line_no, error))
+                    continue
+                batch.append((line_no, username, password))
+                if len(batch) >= batch_size:
+                    flush(batch)
+                    batch = []
+            if batch:
+                flush(batch)
+        report['elapsed'] = time.perf_counter() - start
+        report['per_second'] = report['read'] / report['elapsed'] if report['elapsed'] else 0.0
+        return report
+
+# Audit log class
+# Events are typed records appended to a bounded ring buffer. A background
+# thread drains the buffer in batches to a rotating JSONL file, so callers
+# never wait on disk. If the writer falls behind, the oldest unwritten events
+# are dropped and counted in `dropped`.
+AuditEvent = namedtuple('AuditEvent', ['timestamp', 'action', 'actor', 'details'])
+
+class AuditLog:
+    def __init__(self, path='audit.jsonl', capacity=100000, batch_size=1000,
+                 flush_interval=1.0, max_bytes=10 * 1024 * 1024, backups=5):
+        self.path = path
+        self.buffer = deque(maxlen=capacity)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.recorded = 0
+        self.written = 0
+        self.lock = threading.Lock()  # Serializes drains between the writer thread and flush()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.file = open(path, 'a', encoding='utf-8')
+        self.writer = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    @property
+    def dropped(self):
+        return self.recorded - self.written - len(self.buffer)
+
+    def record(self, action, actor=None, **details):
+        self.buffer.append(AuditEvent(time.time(), action, actor, details))
+        self.recorded += 1
+        if len(self.buffer) >= self.batch_size:
+            self.wakeup.set()
+
+    def _run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            while self.buffer:
+                batch = []
+                try:
+                    while len(batch) < self.batch_size:
+                        batch.append(self.buffer.popleft())
+                except IndexError:
+                    pass
+                self.file.write(''.join(json.dumps(event._asdict(), default=str) + '\n' for event in batch))
+                self.written += len(batch)
+                if self.file.tell() >= self.max_bytes:
+                    self._rotate()
+            self.file.flush()
+
+    def _rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def query(self, start=None, end=None, action=None, actor=None):
+        # Filters written and pending events by time range (datetimes or
+        # epoch seconds), action type and actor, oldest first
+        if isinstance(start, datetime):
+            start = start.timestamp()
+        if isinstance(end, datetime):
+            end = end.timestamp()
+        self.flush()
+        paths = [f"{self.path}.{i}" for i in range(self.backups, 0, -1)] + [self.path]
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    event = AuditEvent(**json.loads(line))
+                    if start is not None and event.timestamp < start:
+                        continue
+                    if end is not None and event.timestamp > end:
+                        continue
+                    if action is not None and event.action != action:
+                        continue
+                    if actor is not None and event.actor != actor:
+                        continue
+                    yield event
+
+    def close(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.wakeup.set()
+        self.writer.join()
+        self.flush()
+        self.file.close()
+
 # Admin class
 class Admin:
-    def __init__(self):
-        self.admins = {'admin': hashlib.sha256('admin123'.encode()).hexdigest()}
+    def __init__(self, audit_log=None):
+        self.admins = {'admin': hashlib.sha256('admin123'.encode()).hexdigest()}  # Legacy hash, still accepted
         self.logged_in = False
         self.current_user = None
-        self.audit_log = []
+        self.audit_log = audit_log if audit_log is not None else AuditLog()
 
     def login(self, username, password):
-        hashed_password = hashlib.sha256(password.encode()).hexdigest()
-        if username in self.admins and self.admins[username] == hashed_password:
+        if username in self.admins and verify_password(password, self.admins[username]):
             self.logged_in = True
             self.current_user = username
-            self.log_action(f"Admin {username} logged in")
+            self.log_action('login')
             return True
+        self.audit_log.record('login_failed', actor=username)
         return False
 
-    def log_action(self, action):
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.audit_log.append(f"{timestamp}: {action}")
+    def log_action(self, action, **details):
+        self.audit_log.record(action, actor=self.current_user, **details)
+
+# Storage region class
+# A contiguous range of storage units with its own free-space index and lock.
+# Free space is kept as segments indexed by both ends (to coalesce on free)
+# and by size in segregated size classes: sizes below SIZE_CLASS_SPLIT get a
+# class each, larger ones are split into SIZE_CLASS_SPLIT classes per power of
+# two. Each class is a heap of (size, offset), and a bitmask says which
+# classes may hold segments, so indexing a segment and finding a fit both
+# take O(log n); only a request that nothing but a few segments of its own
+# class can hold scans that class. Heap entries of segments that were taken or merged are left
+# in place and skipped when they come up.
+SIZE_CLASS_BITS = 4
+SIZE_CLASS_SPLIT = 1 << SIZE_CLASS_BITS
+
+def size_class(size):
+    if size < SIZE_CLASS_SPLIT:
+        return size
+    shift = size.bit_length() - 1 - SIZE_CLASS_BITS
+    return (shift + 1 << SIZE_CLASS_BITS) + (size >> shift & SIZE_CLASS_SPLIT - 1)
+
+def size_class_floor(size_cls):
+    # Smallest size in a class
+    if size_cls < SIZE_CLASS_SPLIT:
+        return size_cls
+    shift = (size_cls >> SIZE_CLASS_BITS) - 1
+    return (SIZE_CLASS_SPLIT + (size_cls & SIZE_CLASS_SPLIT - 1)) << shift
+
+class StorageRegion:
+    def __init__(self, start, size):
+        self.start = start
+        self.size = size
+        self.used = 0
+        self.lock = threading.Lock()
+        self.free_by_class = {}     # size class -> heap of (size, offset)
+        self.classes = 0            # bit c set: class c may hold free segments
+        self.stale = 0              # heap entries left behind by taken segments
+        self.free_by_start = {}     # offset -> size
+        self.free_by_end = {}       # offset + size -> offset
+        self.shared = False         # free-space index still shared with the region it was forked from
+        if size > 0:
+            self._index_free(start, size)
+
+    def fork(self):
+        clone = StorageRegion.__new__(StorageRegion)
+        clone.__dict__.update(self.__dict__)
+        clone.lock = threading.Lock()
+        clone.shared = True
+        return clone
+
+    def _own_free_space(self):
+        self.free_by_class = {size_cls: heap.copy() for size_cls, heap in self.free_by_class.items()}
+        self.free_by_start = self.free_by_start.copy()
+        self.free_by_end = self.free_by_end.copy()
+        self.shared = False
+
+    def rebuild_index(self):
+        # Rebuilds the size classes from free_by_start, e.g. after loading a snapshot
+        self.free_by_class = {}
+        for offset, size in self.free_by_start.items():
+            self.free_by_class.setdefault(size_class(size), []).append((size, offset))
+        for heap in self.free_by_class.values():
+            heapq.heapify(heap)
+        self.classes = sum(1 << size_cls for size_cls in self.free_by_class)
+        self.stale = 0
+        self.free_by_end = {offset + size: offset for offset, size in self.free_by_start.items()}
+        self.shared = False
+
+    def _index_free(self, offset, size):
+        if self.shared:
+            self._own_free_space()
+        self.free_by_start[offset] = size
+        self.free_by_end[offset + size] = offset
+        size_cls = size_class(size)
+        heapq.heappush(self.free_by_class.setdefault(size_cls, []), (size, offset))
+        self.classes |= 1 << size_cls
+
+    def _unindex_free(self, offset, size):
+        if self.shared:
+            self._own_free_space()
+        del self.free_by_start[offset]
+        del self.free_by_end[offset + size]
+        # Drop stale entries once they outnumber the live segments
+        self.stale += 1
+        if self.stale > len(self.free_by_start) + 64:
+            self.rebuild_index()
+
+    def _smallest(self, size_cls):
+        # Smallest live (size, offset) in a class, dropping stale heads
+        heap = self.free_by_class.get(size_cls)
+        while heap:
+            size, offset = heap[0]
+            if self.free_by_start.get(offset) == size:
+                return heap[0]
+            if self.shared:
+                self._own_free_space()
+                heap = self.free_by_class[size_cls]
+            heapq.heappop(heap)
+            self.stale -= 1
+        self.classes &= ~(1 << size_cls)
+        return None
+
+    def _find(self, units):
+        # Best fit when the request's own class holds a big enough segment at
+        # its head, otherwise the smallest segment of the next class that has
+        # one. Only when no larger class has any does the own class get
+        # scanned for a segment that fits.
+        own = size_class(units)
+        size_cls = own
+        if size_class_floor(own) < units:
+            head = self._smallest(own)
+            if head is not None and head[0] >= units:
+                return head
+            size_cls += 1
+        candidates = self.classes >> size_cls << size_cls
+        while candidates:
+            lowest = (candidates & -candidates).bit_length() - 1
+            head = self._smallest(lowest)
+            if head is not None:
+                return head
+            candidates &= candidates - 1
+        if size_cls == own:
+            return None
+        return min((entry for entry in self.free_by_class.get(own, ())
+                    if entry[0] >= units and self.free_by_start.get(entry[1]) == entry[0]), default=None)
+
+    def largest(self):
+        # Size of the largest free segment, 0 if there is none
+        return max(self.free_by_start.values(), default=0)
+
+    def take(self, units):
+        with self.lock:
+            found = self._find(units)
+            if found is None:
+                return None
+            size, offset = found
+            self._unindex_free(offset, size)
+            if size > units:
+                self._index_free(offset + units, size - units)
+            self.used += units
+            return offset
+
+    def take_at(self, offset, units):
+        # Recovery only: carves out the exact segment a logged allocation got
+        with self.lock:
+            start = offset if offset in self.free_by_start else next(
+                begin for begin, size in self.free_by_start.items() if begin < offset < begin + size)
+            size = self.free_by_start[start]
+            self._unindex_free(start, size)
+            if offset > start:
+                self._index_free(start, offset - start)
+            if start + size > offset + units:
+                self._index_free(offset + units, start + size - offset - units)
+            self.used += units
+
+    def release(self, offset, size):
+        with self.lock:
+            self.used -= size
+            left = self.free_by_end.get(offset)
+            if left is not None:
+                left_size = self.free_by_start[left]
+                self._unindex_free(left, left_size)
+                offset, size = left, size + left_size
+            right_size = self.free_by_start.get(offset + size)
+            if right_size is not None:
+                self._unindex_free(offset + size, right_size)
+                size += right_size
+            self._index_free(offset, size)
+
+# Block table class
+# Storage blocks as a struct of arrays: one typed array column per field,
+# indexed by block id, about 41 bytes per block instead of a six-key dict
+# with two datetimes. Timestamps are epoch seconds and blood types are small
+# integer codes. A block with used == 0 is gone; its row is recycled once the
+# allocator has dropped the block's heap entry. A fork shares the columns and
+# copies a column the first time it writes to it.
+class BlockTable:
+    COLUMNS = (('offset', 'q'), ('size', 'q'), ('used', 'q'), ('type_code', 'b'), ('entry', 'q'), ('expiry', 'q'))
+
+    def __init__(self):
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, array(typecode))
+        self.free_rows = []
+        self.live = 0
+        self.shared = set()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.live
+
+    def __contains__(self, block_id):
+        return 0 <= block_id < len(self.used) and self.used[block_id] > 0
+
+    def fork(self):
+        clone = BlockTable.__new__(BlockTable)
+        clone.__dict__.update(self.__dict__)
+        clone.free_rows = self.free_rows.copy()
+        clone.shared = {name for name, _ in self.COLUMNS}
+        clone.lock = threading.Lock()
+        return clone
+
+    def _own(self, *names):
+        for name in names:
+            if name in self.shared:
+                setattr(self, name, array(getattr(self, name).typecode, getattr(self, name)))
+                self.shared.discard(name)
+
+    def add(self, offset, units, type_code, entry, expiry):
+        if self.shared:
+            self._own(*(name for name, _ in self.COLUMNS))
+        with self.lock:
+            if self.free_rows:
+                block_id = self.free_rows.pop()
+            else:
+                block_id = len(self.used)
+                for name, _ in self.COLUMNS:
+                    getattr(self, name).append(0)
+            self.live += 1
+        self.offset[block_id] = offset
+        self.size[block_id] = units
+        self.used[block_id] = units
+        self.type_code[block_id] = type_code
+        self.entry[block_id] = entry
+        self.expiry[block_id] = expiry
+        return block_id
+
+    def add_at(self, block_id, offset, units, type_code, entry, expiry):
+        # Recovery only: re-creates a logged block under its original id
+        if block_id >= len(self.used):
+            # Rows skipped here belong to allocations logged after this one
+            skipped = range(len(self.used), block_id)
+            for name, _ in self.COLUMNS:
+                getattr(self, name).extend([0] * (block_id + 1 - len(getattr(self, name))))
+            self.free_rows[:0] = skipped
+        elif self.free_rows and self.free_rows[-1] == block_id:
+            self.free_rows.pop()
+        else:
+            self.free_rows.remove(block_id)
+        self.live += 1
+        self.offset[block_id] = offset
+        self.size[block_id] = units
+        self.used[block_id] = units
+        self.type_code[block_id] = type_code
+        self.entry[block_id] = entry
+        self.expiry[block_id] = expiry
+
+    def shrink(self, block_id, units):
+        if self.shared:
+            self._own('size', 'used')
+        self.size[block_id] -= units
+        self.used[block_id] -= units
+
+    def remove(self, block_id):
+        if self.shared:
+            self._own('size', 'used')
+        self.size[block_id] = 0
+        self.used[block_id] = 0
+        with self.lock:
+            self.live -= 1
+
+    def recycle(self, block_id):
+        self.free_rows.append(block_id)
+
+    def nbytes(self):
+        return sum(getattr(self, name).buffer_info()[1] * getattr(self, name).itemsize for name, _ in self.COLUMNS)
 
 # Memory management class
+# Storage is split into `regions` StorageRegions, each locked separately. A
+# blood type allocates from its home region first and spills into the others.
+# Each donation (a lot) gets a block of exactly the units it needs, recorded
+# in a BlockTable. Occupied blocks are indexed per blood type in a min-heap
+# keyed by expiry, so dispensing is first-expired-first-out. Heap entries are
+# single ints (expiry seconds << 32 | block id) to keep them small; entries
+# of freed blocks are skipped lazily. Per-type state is guarded by a per-type
+# lock, always taken before a region lock, so work on different blood types
+# does not contend. The _-prefixed per-type methods expect the caller to hold
+# that lock already. Used totals are kept incrementally, so status is O(1).
+ID_BITS = 32
+ID_MASK = (1 << ID_BITS) - 1
+
 class MemoryManager:
-    def __init__(self):
-        self.total_capacity = 1000
-        self.storage_blocks = []
+    def __init__(self, total_capacity=1000, audit=None, regions=1):
+        self.total_capacity = total_capacity
+        self.audit = audit
+        self.blocks = BlockTable()
+        self.blocks_by_type = {}    # blood type -> heap of expiry << ID_BITS | block id
+        self.used_by_type = {}
+        self.type_names = []        # type code -> blood type
+        self.type_codes = {}        # blood type -> type code
+        self.type_locks = {}
+        self.shared = set()         # heaps a fork still shares with its parent
+        self.wal = None             # WriteAheadLog, when the state is persistent
+        self.regions = []
+        self.region_size = max(1, -(-total_capacity // max(1, regions)))
         self.initialize_storage()
 
     def initialize_storage(self):
-        block_size = 100
-        for i in range(0, self.total_capacity, block_size):
-            self.storage_blocks.append({
-                'id': len(self.storage_blocks),
-                'size': block_size,
-                'used': 0,
-                'blood_type': None,
-                'entry_date': None,
-                'expiry_date': None
-            })
+        for start in range(0, self.total_capacity, self.region_size):
+            self.regions.append(StorageRegion(start, min(self.region_size, self.total_capacity - start)))
+
+    @property
+    def used_space(self):
+        return sum(region.used for region in self.regions)
+
+    def fork(self):
+        # Copy-on-write snapshot for what-if runs. The block table and
+        # per-type heaps are copied on first write, so forking costs
+        # O(blood types + regions). The fork is valid while this manager is
+        # not modified.
+        clone = MemoryManager.__new__(MemoryManager)
+        clone.__dict__.update(self.__dict__)
+        # Metrics wrappers live in the instance dict and are bound to this
+        # manager; the fork must use its own methods
+        for name in self.__dict__.keys() & vars(MemoryManager).keys():
+            del clone.__dict__[name]
+        clone.audit = None
+        clone.wal = None
+        clone.blocks = self.blocks.fork()
+        clone.blocks_by_type = dict(self.blocks_by_type)
+        clone.used_by_type = dict(self.used_by_type)
+        clone.type_locks = {}
+        clone.shared = set(self.blocks_by_type)
+        clone.regions = [region.fork() for region in self.regions]
+        return clone
+
+    def type_lock(self, blood_type):
+        lock = self.type_locks.get(blood_type)
+        if lock is None:
+            lock = self.type_locks.setdefault(blood_type, threading.RLock())
+        return lock
+
+    def _type_code(self, blood_type):
+        code = self.type_codes.get(blood_type)
+        if code is None:
+            with self.blocks.lock:
+                code = self.type_codes.setdefault(blood_type, len(self.type_names))
+                if code == len(self.type_names):
+                    self.type_names.append(blood_type)
+        return code
+
+    def _writable_heap(self, blood_type):
+        heap = self.blocks_by_type.get(blood_type)
+        if heap is None or blood_type in self.shared:
+            heap = self.blocks_by_type[blood_type] = list(heap or [])
+            self.shared.discard(blood_type)
+        return heap
+
+    def _pop_head(self, heap):
+        # Drops the head entry; its block is gone, so the row can be reused
+        block_id = heapq.heappop(heap) & ID_MASK
+        if self.wal:
+            self.wal.append('pop', block_id)
+        self.blocks.recycle(block_id)
+
+    def _region_of(self, offset):
+        return self.regions[offset // self.region_size]
+
+    def _home_regions(self, blood_type):
+        home = zlib.crc32(blood_type.encode()) % len(self.regions)
+        return self.regions[home:] + self.regions[:home]
+
+    def get_block(self, block_id):
+        if block_id not in self.blocks:
+            return None
+        blocks = self.blocks
+        return {
+            'id': block_id,
+            'offset': blocks.offset[block_id],
+            'size': blocks.size[block_id],
+            'used': blocks.used[block_id],
+            'blood_type': self.type_names[blocks.type_code[block_id]],
+            'entry_date': datetime.fromtimestamp(blocks.entry[block_id]),
+            'expiry_date': datetime.fromtimestamp(blocks.expiry[block_id])
+        }
+
+    def allocate_block(self, blood_type, units, entry_date=None, expiry_date=None):
+        if units <= 0:
+            return None
+        entry_date = entry_date or datetime.now()
+        expiry_date = expiry_date or entry_date + timedelta(days=30)
+        expiry = int(expiry_date.timestamp())
+        # Space is taken under the type lock, so a checkpoint never sees it
+        # gone without a block that owns it
+        with self.type_lock(blood_type):
+            for region in self._home_regions(blood_type):
+                offset = region.take(units)
+                if offset is not None:
+                    break
+            else:
+                return None
+            block_id = self.blocks.add(offset, units, self._type_code(blood_type), int(entry_date.timestamp()), expiry)
+            heapq.heappush(self._writable_heap(blood_type), expiry << ID_BITS | block_id)
+            self.used_by_type[blood_type] = self.used_by_type.get(blood_type, 0) + units
+            if self.wal:
+                self.wal.append('alloc', block_id, offset, units, blood_type, int(entry_date.timestamp()), expiry)
+        if self.audit:
+            self.audit.record('allocate', block_id=block_id, blood_type=blood_type, units=units, offset=offset)
+        return block_id
+
+    def free_block(self, block_id, units=None):
+        # Frees the whole block, or shrinks it by `units` and returns its tail
+        # to free space. Returns the number of units freed.
+        if block_id not in self.blocks:
+            return 0
+        with self.type_lock(self.type_names[self.blocks.type_code[block_id]]):
+            return self._free_block(block_id, units)
+
+    def _free_block(self, block_id, units=None):
+        blocks = self.blocks
+        if block_id not in blocks:
+            return 0
+        blood_type = self.type_names[blocks.type_code[block_id]]
+        offset, size, used = blocks.offset[block_id], blocks.size[block_id], blocks.used[block_id]
+        if self.wal:
+            # Logged before the space is released, so a later allocation
+            # that reuses it is always logged after this
+            self.wal.append('free', block_id, units if units is not None and units < used else used)
+        if units is None or units >= used:
+            units = used
+            blocks.remove(block_id)
+            self._region_of(offset).release(offset, size)
+        else:
+            blocks.shrink(block_id, units)
+            self._region_of(offset).release(offset + size - units, units)
+        self.used_by_type[blood_type] -= units
+        if self.audit:
+            self.audit.record('free', block_id=block_id, blood_type=blood_type, units=units)
+        return units
 
     def allocate_memory(self, blood_type, units):
-        best_block = None
-        min_waste = float('inf')
-
-        for block in self.storage_blocks:
-            if block['blood_type'] is None:
-                waste = block['size'] - units
-                if waste >= 0 and waste < min_waste:
-                    min_waste = waste
-                    best_block = block
-
-        if best_block:
-            best_block['blood_type'] = blood_type
-            best_block['used'] = units
-            best_block['entry_date'] = datetime.now()
-            best_block['expiry_date'] = datetime.now() + timedelta(days=30)
-            return True
-        return False
+        return self.allocate_block(blood_type, units) is not None
+
+    def redo(self, op, *args):
+        # Re-applies one logged allocator change during recovery
+        if op == 'alloc':
+            block_id, offset, units, blood_type, entry, expiry = args
+            self._region_of(offset).take_at(offset, units)
+            self.blocks.add_at(block_id, offset, units, self._type_code(blood_type), entry, expiry)
+            heapq.heappush(self._writable_heap(blood_type), expiry << ID_BITS | block_id)
+            self.used_by_type[blood_type] = self.used_by_type.get(blood_type, 0) + units
+        elif op == 'free':
+            self.free_block(*args)
+        elif op == 'pop':
+            block_id, = args
+            heap = self._writable_heap(self.type_names[self.blocks.type_code[block_id]])
+            if heap[0] & ID_MASK != block_id:
+                # Pops of two types were logged out of order; move it to the head
+                heap.remove(next(entry for entry in heap if entry & ID_MASK == block_id))
+                heapq.heapify(heap)
+            else:
+                heapq.heappop(heap)
+            self.blocks.recycle(block_id)
 
     def deallocate_memory(self, blood_type, units):
-        for block in self.storage_blocks:
-            if block['blood_type'] == blood_type and block['used'] >= units:
-                block['used'] -= units
-                if block['used'] == 0:
-                    block['blood_type'] = None
-                    block['entry_date'] = None
-                    block['expiry_date'] = None
-                return True
-        return False
+        with self.type_lock(blood_type):
+            return self._deallocate(blood_type, units)
+
+    def _deallocate(self, blood_type, units):
+        if units <= 0 or self.used_by_type.get(blood_type, 0) < units:
+            return False
+        heap = self._writable_heap(blood_type)
+        while units > 0:
+            block_id = heap[0] & ID_MASK
+            if block_id in self.blocks:
+                units -= self._free_block(block_id, units)
+            if block_id not in self.blocks:
+                self._pop_head(heap)
+        return True
+
+    def _live_head(self, blood_type):
+        heap = self.blocks_by_type.get(blood_type)
+        while heap and (heap[0] & ID_MASK) not in self.blocks:
+            heap = self._writable_heap(blood_type)
+            self._pop_head(heap)
+        return heap[0] if heap else None
+
+    def earliest_expiry(self, blood_type):
+        with self.type_lock(blood_type):
+            return self._earliest_expiry(blood_type)
+
+    def _earliest_expiry(self, blood_type):
+        head = self._live_head(blood_type)
+        return datetime.fromtimestamp(head >> ID_BITS) if head is not None else None
+
+    def release_expired(self, blood_type, now=None):
+        # Frees every block of this type that expired at or before `now`;
+        # returns the number of units freed
+        with self.type_lock(blood_type):
+            return self._release_expired(blood_type, now)
+
+    def _release_expired(self, blood_type, now=None):
+        now_ts = (now or datetime.now()).timestamp()
+        freed = 0
+        head = self._live_head(blood_type)
+        while head is not None and (head >> ID_BITS) <= now_ts:
+            freed += self._free_block(head & ID_MASK)
+            self._pop_head(self._writable_heap(blood_type))
+            head = self._live_head(blood_type)
+        return freed
 
     def get_memory_status(self):
-        used_space = sum(block['used'] for block in self.storage_blocks)
+        used_space = self.used_space
         return {
             'total': self.total_capacity,
             'used': used_space,
             'available': self.total_capacity - used_space,
+            'by_type': {bt: units for bt, units in self.used_by_type.items() if units},
+        }
+
+    def get_fragmentation_stats(self):
+        # External fragmentation is measured inside each region, since blocks
+        # never span regions anyway
+        free_space = self.total_capacity - self.used_space
+        largest = [size for size in (region.largest() for region in self.regions) if size]
+        return {
+            'occupied_blocks': len(self.blocks),
+            'regions': len(self.regions),
+            'free_segments': sum(len(region.free_by_start) for region in self.regions),
+            'largest_free': max(largest, default=0),
+            'external_fragmentation': round(1 - sum(largest) / free_space, 4) if free_space else 0.0,
         }
 
-# Blood inventory class
+# Blood type compatibility
+# A type is its set of antigens (A, B and Rh D). Red cells can go to any
+# recipient that carries every antigen the donor carries, so O- goes to all
+# and AB+ receives from all. COMPATIBLE_DONORS holds, per recipient, a bitmask
+# over BLOOD_TYPES of the donor types it may receive.
+BLOOD_TYPES = ['A+', 'A-', 'B+', 'B-', 'AB+', 'AB-', 'O+', 'O-']
+TYPE_INDEX = {bt: i for i, bt in enumerate(BLOOD_TYPES)}
+
+def antigens(blood_type):
+    return ('A' in blood_type) | ('B' in blood_type) << 1 | blood_type.endswith('+') << 2
+
+COMPATIBLE_DONORS = {
+    recipient: sum(1 << d for d, donor in enumerate(BLOOD_TYPES) if not antigens(donor) & ~antigens(recipient))
+    for recipient in BLOOD_TYPES
+}
+
+def can_donate(donor, recipient):
+    return bool(COMPATIBLE_DONORS[recipient] >> TYPE_INDEX[donor] & 1)
+
+# Cost of serving a recipient from a donor type: 0 for an exact match, one
+# per antigen the donor lacks, plus a premium on O- since it is the only
+# type every recipient can take. None means incompatible.
+O_NEG_PREMIUM = 3
+SUBSTITUTION_COST = [[None if not can_donate(donor, recipient) else
+                      bin(antigens(recipient)).count('1') - bin(antigens(donor)).count('1')
+                      + (O_NEG_PREMIUM if donor == 'O-' and recipient != 'O-' else 0)
+                      for recipient in BLOOD_TYPES] for donor in BLOOD_TYPES]
+# Donor types to fall back on per recipient, cheapest first, so O- is last
+SUBSTITUTES = {
+    recipient: sorted((donor for donor in BLOOD_TYPES if donor != recipient and can_donate(donor, recipient)),
+                      key=lambda donor: (SUBSTITUTION_COST[TYPE_INDEX[donor]][r], TYPE_INDEX[donor]))
+    for r, recipient in enumerate(BLOOD_TYPES)
+}
+
+def min_cost_transport(supply, demand):
+    # Min-cost max-flow from donor stock to recipient demand over the 8x8
+    # compatibility graph, by successive shortest paths (Bellman-Ford, since
+    # residual edges have negative costs). The graph has 18 nodes, so each
+    # solve takes well under a millisecond. Returns flow[donor][recipient].
+    n = len(BLOOD_TYPES)
+    source, sink = 2 * n, 2 * n + 1
+    graph = [[] for _ in range(2 * n + 2)]  # node -> edge ids; edge ^ 1 is its reverse
+    head, cap, cost = [], [], []
+
+    def add_edge(u, v, capacity, c):
+        for a, b, width, price in ((u, v, capacity, c), (v, u, 0, -c)):
+            graph[a].append(len(head))
+            head.append(b)
+            cap.append(width)
+            cost.append(price)
+
+    pairs = {}
+    for d in range(n):
+        if supply[d] > 0:
+            add_edge(source, d, int(supply[d]), 0)
+    for r in range(n):
+        if demand[r] > 0:
+            add_edge(n + r, sink, int(demand[r]), 0)
+            for d in range(n):
+                if supply[d] > 0 and SUBSTITUTION_COST[d][r] is not None:
+                    pairs[d, r] = len(head)
+                    add_edge(d, n + r, int(supply[d]), SUBSTITUTION_COST[d][r])
+    while True:
+        dist = [float('inf')] * len(graph)
+        via = [None] * len(graph)
+        dist[source] = 0
+        for _ in range(len(graph) - 1):
+            changed = False
+            for u, edges in enumerate(graph):
+                if dist[u] == float('inf'):
+                    continue
+                for e in edges:
+                    if cap[e] > 0 and dist[u] + cost[e] < dist[head[e]]:
+                        dist[head[e]] = dist[u] + cost[e]
+                        via[head[e]] = e
+                        changed = True
+            if not changed:
+                break
+        if via[sink] is None:
+            break
+        push, v = float('inf'), sink
+        while v != source:
+            push = min(push, cap[via[v]])
+            v = head[via[v] ^ 1]
+        v = sink
+        while v != source:
+            cap[via[v]] -= push
+            cap[via[v] ^ 1] += push
+            v = head[via[v] ^ 1]
+    flow = [[0] * n for _ in range(n)]
+    for (d, r), e in pairs.items():
+        flow[d][r] = cap[e ^ 1]
+    return flow
+
+def allocate_batch(units, recipients, priorities, supply):
+    # Assigns stock to a whole batch of requests at once. Priority levels are
+    # served highest first; each level gets a min-cost transport of what is
+    # left, which maximises the units it receives while keeping substitutes,
+    # and O- above all, for when the exact type has run out. Requests are all
+    # or nothing, so within a recipient type the flow is handed out first fit
+    # in FIFO order: a request that does not fit is skipped and smaller ones
+    # behind it still get served. Flow that no request could use goes back to
+    # stock and the level is solved again for the requests still waiting,
+    # leaving out any that are larger than all the stock they can take. If a
+    # solve serves nothing, the first waiting request is filled on its own,
+    # cheapest donors first. Arrays are indexed by request, recipients hold
+    # TYPE_INDEX codes (-1 for invalid ones).
+    # Returns (served mask, drawn[donor][recipient] units).
+    n = len(BLOOD_TYPES)
+    units = np.asarray(units, dtype=np.int64)
+    recipients = np.asarray(recipients, dtype=np.int64)
+    priorities = np.asarray(priorities)
+    supply = np.array(supply, dtype=np.int64)
+    served = np.zeros(len(units), dtype=bool)
+    drawn = np.zeros((n, n), dtype=np.int64)
+    active = (recipients >= 0) & (units > 0)
+    donors = [[TYPE_INDEX[donor] for donor in [recipient] + SUBSTITUTES[recipient]] for recipient in BLOOD_TYPES]
+    for level in np.unique(priorities[active])[::-1]:
+        waiting = np.flatnonzero(active & (priorities == level))
+        while supply.any():
+            reach = np.array([supply[donors[r]].sum() for r in range(n)])
+            waiting = waiting[units[waiting] <= reach[recipients[waiting]]]
+            if not len(waiting):
+                break
+            demand = np.bincount(recipients[waiting], weights=units[waiting], minlength=n)
+            flow = min_cost_transport(supply, demand)
+            before = served.sum()
+            for r in range(n):
+                total = sum(flow[d][r] for d in range(n))
+                if not total:
+                    continue
+                queue = waiting[recipients[waiting] == r]
+                sizes = units[queue]
+                filled = np.cumsum(sizes)
+                count = int(np.searchsorted(filled, total, side='right'))
+                served[queue[:count]] = True
+                needed = int(filled[count - 1]) if count else 0
+                # First fit past the prefix: skip requests that no longer fit and
+                # keep handing out what is left to smaller ones behind them
+                if count < len(queue):
+                    smallest = np.minimum.accumulate(sizes[::-1])[::-1]
+                    left = total - needed
+                    for i in range(count + 1, len(queue)):
+                        if left < smallest[i]:
+                            break
+                        if sizes[i] <= left:
+                            served[queue[i]] = True
+                            left -= int(sizes[i])
+                    needed = total - left
+                for d in donors[r]:
+                    take = min(flow[d][r], needed)
+                    supply[d] -= take
+                    drawn[d, r] += take
+                    needed -= take
+            if served.sum() == before:
+                # The flow was split so that no request fits; fill the first
+                # one on its own, which reach says is possible
+                first = waiting[0]
+                r, needed = recipients[first], int(units[first])
+                for d in donors[r]:
+                    take = min(int(supply[d]), needed)
+                    supply[d] -= take
+                    drawn[d, r] += take
+                    needed -= take
+                served[first] = True
+            waiting = waiting[~served[waiting]]
+    return served, drawn
+
 class BloodInventory:
-    def __init__(self, memory_manager):
+    def __init__(self, memory_manager, audit=None, clock=datetime.now):
         self.memory_manager = memory_manager
+        self.audit = audit
+        self.clock = clock  # Replays swap in the event time
+        self.reserved = {}
+        self.reservations = {}  # token -> (blood type, units)
+        self.reservation_ids = itertools.count(1)
         self.blood_stock = {
             'A+': {'units': 0, 'expiry': None},
             'A-': {'units': 0, 'expiry': None},
@@ -141,180 +1182,649 @@ class BloodInventory:
             'O+': {'units': 0, 'expiry': None},
             'O-': {'units': 0, 'expiry': None},
         }
+        # One lock per blood type: work on A+ never waits for O-. They are
+        # the allocator's own type locks, so under them the inventory calls
+        # its unlocked internals instead of locking the type a second time
+        self.locks = {bt: memory_manager.type_lock(bt) for bt in self.blood_stock}
+
+    def fork(self):
+        # What-if copy: stock counters are copied, storage is a COW fork
+        clone = BloodInventory(self.memory_manager.fork(), clock=self.clock)
+        clone.blood_stock = {bt: dict(details) for bt, details in self.blood_stock.items()}
+        clone.reserved = dict(self.reserved)
+        return clone
 
-    def donate_blood(self, blood_type, units):
+    def expire_lots(self, blood_type=None, now=None):
+        # Lazily sweeps spoiled lots out of stock and frees their storage
+        blood_types = [blood_type] if blood_type else list(self.blood_stock)
+        now = now or self.clock()
+        now_ts = now.timestamp()
+        expired = {}
+        for bt in blood_types:
+            # The cached next expiry says whether there is anything to sweep
+            expiry = self.blood_stock[bt]['expiry']
+            if expiry is None or expiry.timestamp() > now_ts:
+                continue
+            with self.locks[bt]:
+                units = self.memory_manager._release_expired(bt, now)
+                if units:
+                    self.blood_stock[bt]['units'] -= units
+                    self.blood_stock[bt]['expiry'] = self.memory_manager._earliest_expiry(bt)
+                    expired[bt] = units
+            if units and self.audit:
+                self.audit.record('expire', blood_type=bt, units=units)
+        return expired
+
+    def donate_blood(self, blood_type, units, expiry_date=None):
         if blood_type not in self.blood_stock:
-            print(Fore.RED + "❌ Invalid blood type!" + Style.RESET_ALL)
+            emit('donate', ok=False, blood_type=blood_type, units=units, reason='invalid_type')
             return False
         if units <= 0:
-            print(Fore.RED + "❌ Units must be positive!" + Style.RESET_ALL)
+            emit('donate', ok=False, blood_type=blood_type, units=units, reason='invalid_units')
+            return False
+        now = self.clock()
+        if expiry_date is not None and expiry_date <= now:
+            emit('donate', ok=False, blood_type=blood_type, units=units, reason='expired')
             return False
-        if self.memory_manager.allocate_memory(blood_type, units):
-            expiry_date = datetime.now() + timedelta(days=30)
-            self.blood_stock[blood_type]['units'] += units
-            self.blood_stock[blood_type]['expiry'] = expiry_date
-            print(Fore.GREEN + f"✅ Success! {units} units of {blood_type} added to stock (Expiry: {expiry_date})." + Style.RESET_ALL)
+        self.expire_lots(blood_type, now)
+        expiry_date = expiry_date or now + timedelta(days=30)
+        with self.locks[blood_type]:
+            block_id = self.memory_manager.allocate_block(blood_type, units, entry_date=now, expiry_date=expiry_date)
+            if block_id is not None:
+                self.blood_stock[blood_type]['units'] += units
+                self.blood_stock[blood_type]['expiry'] = self.memory_manager._earliest_expiry(blood_type)
+        if self.audit:
+            self.audit.record('donate', blood_type=blood_type, units=units, ok=block_id is not None, lot=block_id)
+        if block_id is not None:
+            emit('donate', ok=True, blood_type=blood_type, units=units, expiry=expiry_date, lot=block_id)
             return True
         else:
-            print(Fore.RED + "❌ Storage capacity full!" + Style.RESET_ALL)
+            emit('donate', ok=False, blood_type=blood_type, units=units, reason='capacity_full')
             return False
 
-    def request_blood(self, blood_type, units):
+    def refresh_stock(self):
+        # Rebuilds the per-type counters from the allocator, e.g. after recovery
+        for bt, details in self.blood_stock.items():
+            details['units'] = self.memory_manager.used_by_type.get(bt, 0)
+            details['expiry'] = self.memory_manager.earliest_expiry(bt)
+
+    def available_units(self, blood_type):
+        return self.blood_stock[blood_type]['units'] - self.reserved.get(blood_type, 0)
+
+    def _dispense(self, blood_type, units):
+        # Lots are consumed first-expired-first-out; caller holds the type lock
+        if not self.memory_manager._deallocate(blood_type, units):
+            return False
+        self.blood_stock[blood_type]['units'] -= units
+        self.blood_stock[blood_type]['expiry'] = self.memory_manager._earliest_expiry(blood_type)
+        return True
+
+    @contextmanager
+    def locked(self, blood_types):
+        # Takes several type locks in one fixed order, so two multi-type
+        # dispenses can never deadlock
+        with ExitStack() as stack:
+            for bt in sorted(blood_types):
+                stack.enter_context(self.locks[bt])
+            yield
+
+    def _dispense_compatible(self, recipient, units):
+        # Fills a request from the exact type first, then from compatible
+        # substitutes cheapest first. Returns {donor type: units} or None.
+        donors = [recipient] + SUBSTITUTES[recipient]
+        # Expiry only shrinks stock, so a shortfall before sweeping is final;
+        # most failed requests stop here without touching any lock
+        if sum(self.available_units(bt) for bt in donors) < units:
+            return None
+        for bt in donors[1:]:
+            self.expire_lots(bt)
+        with self.locked(donors):
+            plan = {}
+            needed = units
+            for bt in donors:
+                take = min(self.available_units(bt), needed)
+                if take > 0:
+                    plan[bt] = take
+                    needed -= take
+                if not needed:
+                    break
+            if needed:
+                return None
+            for bt, take in plan.items():
+                if not self._dispense(bt, take):
+                    return None
+        return plan
+
+    def dispense_batch(self, draws):
+        # Dispenses the per-type totals of a batch allocation; the caller
+        # holds the locks of every type involved
+        for bt, units in draws.items():
+            dispensed = self._dispense(bt, units)
+            if self.audit:
+                self.audit.record('request', blood_type=bt, units=units, ok=dispensed, batch=True)
+
+    def request_blood(self, blood_type, units, substitute=True):
         if blood_type not in self.blood_stock:
-            print(Fore.RED + "❌ Invalid blood type!" + Style.RESET_ALL)
+            emit('request', ok=False, blood_type=blood_type, units=units, reason='invalid_type')
             return False
         if units <= 0:
-            print(Fore.RED + "❌ Units must be positive!" + Style.RESET_ALL)
+            emit('request', ok=False, blood_type=blood_type, units=units, reason='invalid_units')
+            return False
+        self.expire_lots(blood_type)
+        with self.locks[blood_type]:
+            available = self.available_units(blood_type)
+            dispensed = available >= units and self._dispense(blood_type, units)
+        drawn = None
+        if available < units and substitute:
+            drawn = self._dispense_compatible(blood_type, units)
+            dispensed = drawn is not None
+        if self.audit:
+            details = {'drawn': drawn} if drawn else {}
+            self.audit.record('request', blood_type=blood_type, units=units, ok=dispensed, **details)
+        if dispensed:
+            emit('request', ok=True, blood_type=blood_type, units=units, drawn=drawn)
+            return True
+        elif available >= units:
+            emit('request', ok=False, blood_type=blood_type, units=units, reason='deallocation_failed')
             return False
-        if self.blood_stock[blood_type]['units'] >= units:
-            if self.memory_manager.deallocate_memory(blood_type, units):
-                self.blood_stock[blood_type]['units'] -= units
-                if self.blood_stock[blood_type]['units'] == 0:
-                    self.blood_stock[blood_type]['expiry'] = None
-                print(Fore.GREEN + f"✅ Success! {units} units of {blood_type} dispensed." + Style.RESET_ALL)
-                return True
-            else:
-                print(Fore.RED + "❌ Memory deallocation failed!" + Style.RESET_ALL)
-                return False
         else:
-            print(Fore.RED + f"❌ Insufficient stock for {blood_type}! Available: {self.blood_stock[blood_type]['units']} units" + Style.RESET_ALL)
+            emit('request', ok=False, blood_type=blood_type, units=units, reason='insufficient', available=available)
             return False
 
+    def reserve(self, blood_type, units):
+        # First half of reserve-then-commit: holds units so no other request
+        # can take them. Returns a token for commit()/cancel(), or None.
+        if blood_type not in self.blood_stock or units <= 0:
+            return None
+        self.expire_lots(blood_type)
+        with self.locks[blood_type]:
+            if self.available_units(blood_type) < units:
+                return None
+            self.reserved[blood_type] = self.reserved.get(blood_type, 0) + units
+            token = next(self.reservation_ids)
+            self.reservations[token] = (blood_type, units)
+        return token
+
+    def commit(self, token):
+        # Dispenses reserved units. Fails if the token is unknown or the
+        # reserved lots expired since.
+        if token not in self.reservations:
+            return False
+        blood_type, units = self.reservations.pop(token)
+        with self.locks[blood_type]:
+            self.reserved[blood_type] -= units
+            dispensed = self._dispense(blood_type, units)
+        if self.audit:
+            self.audit.record('request', blood_type=blood_type, units=units, ok=dispensed, reservation=token)
+        return dispensed
+
+    def cancel(self, token):
+        if token not in self.reservations:
+            return False
+        blood_type, units = self.reservations.pop(token)
+        with self.locks[blood_type]:
+            self.reserved[blood_type] -= units
+        return True
+
     def view_stock(self):
+        self.expire_lots()
         print(Fore.CYAN + "\n🩸 Blood Stock:" + Style.RESET_ALL)
         table = [[bt, details['units'], details['expiry'] if details['expiry'] else "N/A"] 
                  for bt, details in self.blood_stock.items()]
-        print(tabulate(table, headers=["Blood Type", "Units", "Expiry"], tablefmt="grid"))
+        print(tabulate(table, headers=["Blood Type", "Units", "Next Expiry"], tablefmt="grid"))
+
+# Request queue class
+# Pending requests live in one store with two views: a deque of tickets in
+# Round Robin order and a heap for Priority order. Entries removed through one
+# view are skipped lazily by the other. With aging, a request's effective
+# priority grows by aging_rate for every request that arrives after it, so the
+# heap keys never have to be updated.
+class RequestQueue:
+    def __init__(self, aging_rate=0):
+        self.aging_rate = aging_rate
+        self.entries = {}     # ticket -> request
+        self.fifo = deque()   # tickets in Round Robin order
+        self.heap = []        # (key, ticket); smallest key is served first
+        self.next_ticket = 0
+        self.next_id = 1      # next request id handed out by issue_id()
+        self.id_lock = threading.Lock()
+        self.wal = None       # WriteAheadLog, when the state is persistent
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        for ticket in self.fifo:
+            request = self.entries.get(ticket)
+            if request is not None:
+                yield request
+
+    def _key(self, ticket):
+        return self.aging_rate * ticket - self.entries[ticket]['priority']
+
+    def append(self, request):
+        ticket = self.next_ticket
+        self.next_ticket += 1
+        self.entries[ticket] = request
+        self.fifo.append(ticket)
+        heapq.heappush(self.heap, (self._key(ticket), ticket))
+        if self.wal:
+            self.wal.append('enqueue', ticket, request)
+        return ticket
+
+    def issue_id(self):
+        # Monotonic request ids; with a WAL they survive restarts
+        with self.id_lock:
+            request_id = self.next_id
+            self.next_id += 1
+            if self.wal:
+                self.wal.append('next_id', self.next_id)
+        return request_id
+
+    def remove(self, ticket):
+        if self.wal and ticket in self.entries:
+            self.wal.append('dequeue', ticket)
+        self.entries.pop(ticket, None)
+        # Drop stale tickets once they outnumber the live ones
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [(key, t) for key, t in self.heap if t in self.entries]
+            heapq.heapify(self.heap)
+        if len(self.fifo) > 2 * len(self.entries) + 64:
+            self.fifo = deque(t for t in self.fifo if t in self.entries)
+
+    def next_round_robin(self):
+        # Takes the head ticket off the Round Robin view; the caller must
+        # either requeue() or remove() it
+        while self.fifo:
+            ticket = self.fifo.popleft()
+            request = self.entries.get(ticket)
+            if request is not None:
+                return ticket, request
+        return None
+
+    def requeue(self, ticket, request=None):
+        if request is not None:
+            self.entries[ticket] = request
+        self.fifo.append(ticket)
+        if self.wal:
+            self.wal.append('rotate', ticket, request)
+
+    def pop_priority(self):
+        # Takes the best ticket off the Priority view; the caller must either
+        # restore() or remove() it
+        while self.heap:
+            ticket = heapq.heappop(self.heap)[1]
+            request = self.entries.get(ticket)
+            if request is not None:
+                return ticket, request
+        return None
+
+    def restore(self, ticket):
+        heapq.heappush(self.heap, (self._key(ticket), ticket))
+
+    def ordered(self, limit=None):
+        live = [(key, ticket) for key, ticket in self.heap if ticket in self.entries]
+        live = heapq.nsmallest(limit, live) if limit is not None else sorted(live)
+        return [self.entries[ticket] for _, ticket in live]
+
+    def copy(self):
+        clone = RequestQueue(self.aging_rate)
+        clone.entries = self.entries.copy()
+        clone.fifo = self.fifo.copy()
+        clone.heap = self.heap.copy()
+        clone.next_ticket = self.next_ticket
+        clone.next_id = self.next_id
+        return clone
+
+    def rebuild_heap(self):
+        self.heap = [(self._key(ticket), ticket) for ticket in self.entries]
+        heapq.heapify(self.heap)
+
+    def redo(self, op, *args):
+        # Re-applies one logged queue change during recovery
+        if op == 'enqueue':
+            ticket, request = args
+            self.next_ticket = ticket
+            self.append(request)
+        elif op == 'dequeue':
+            self.remove(args[0])
+        elif op == 'rotate':
+            ticket, request = args
+            entry = self.next_round_robin()
+            if entry is not None and entry[0] != ticket:
+                self.fifo.appendleft(entry[0])
+                self.fifo.remove(ticket)
+            self.requeue(ticket, request)
+        elif op == 'next_id':
+            self.next_id = max(self.next_id, args[0])
 
 # Scheduler class
 class Scheduler:
-    def __init__(self, inventory):
-        self.requests = []
+    def __init__(self, inventory, time_quantum=10, aging_rate=0, audit=None):
+        self.requests = RequestQueue(aging_rate)
         self.inventory = inventory
-        self.time_quantum = 10  # Seconds per time slice for Round Robin
+        self.audit = audit
+        self.lock = threading.RLock()  # Guards the request queue
+        self.time_quantum = time_quantum  # Seconds per time slice for Round Robin
+
+    def fork(self, inventory):
+        clone = Scheduler(inventory, self.time_quantum)
+        clone.requests = self.requests.copy()
+        return clone
+
+    def next_request_id(self):
+        return self.requests.issue_id()
 
     def add_request(self, request):
-        self.requests.append(request)
-        print(Fore.GREEN + f"✅ Request {request['id']} for {request['blood_type']} ({request['units']} units, Priority: {request['priority']}) added." + Style.RESET_ALL)
+        # A bad request would be persisted and later break the safety check
+        if request['blood_type'] not in TYPE_INDEX:
+            emit('queued', ok=False, id=request['id'], blood_type=request['blood_type'], units=request['units'], reason='invalid_type')
+            return False
+        if request['units'] <= 0:
+            emit('queued', ok=False, id=request['id'], blood_type=request['blood_type'], units=request['units'], reason='invalid_units')
+            return False
+        with self.lock:
+            self.requests.append(request)
+        emit('queued', id=request['id'], blood_type=request['blood_type'], units=request['units'], priority=request['priority'])
+        return True
 
-    def process_round_robin(self):
-        print(Fore.CYAN + "\nProcessing Requests (Round Robin, Time Quantum: 10s):" + Style.RESET_ALL)
+    def process_round_robin(self, time_quantum=None, max_iterations=None):
+        with self.lock:
+            return self._process_round_robin(time_quantum, max_iterations)
+
+    def _process_round_robin(self, time_quantum, max_iterations):
+        quantum = time_quantum or self.time_quantum
+        emit('run_start', policy='round_robin', time_quantum=quantum, queued=len(self.requests))
+        result = {'status': 'done', 'processed': [], 'blocked': [], 'iterations': 0}
         if not self.requests:
-            print(Fore.YELLOW + "No requests to process." + Style.RESET_ALL)
-            return
-        processed = []
+            emit('run_end', policy='round_robin', status='done', processed=[], blocked=[])
+            return result
+        processed = result['processed']
         current_time = 0
+        iterations = 0
+        failures = 0  # consecutive failed slices; a full pass of them means no progress is possible
         while self.requests:
-            request = self.requests.pop(0)
+            if max_iterations is not None and iterations >= max_iterations:
+                result['status'] = 'budget_exhausted'
+                break
+            ticket, request = self.requests.next_round_robin()
             units = request['units']
             blood_type = request['blood_type']
-            units_to_process = min(units, self.time_quantum)
-            print(f"[Time {current_time}s] Processing request {request['id']} for {blood_type} ({units_to_process}/{units} units)")
-            if self.inventory.request_blood(blood_type, units_to_process):
+            units_to_process = min(units, quantum)
+            served = self.inventory.request_blood(blood_type, units_to_process)
+            emit('slice', time=current_time, id=request['id'], blood_type=blood_type,
+                 units=units_to_process, requested=units, ok=served)
+            if served:
                 if units > units_to_process:
-                    self.requests.append({
+                    self.requests.requeue(ticket, {
                         'id': request['id'],
                         'blood_type': blood_type,
                         'units': units - units_to_process,
                         'priority': request['priority']
                     })
+                else:
+                    self.requests.remove(ticket)
                 processed.append((request['id'], units_to_process, blood_type))
+                failures = 0
             else:
-                self.requests.append(request)  # Re-queue if failed
-            current_time += self.time_quantum
-        return processed
+                self.requests.requeue(ticket)  # Re-queue if failed
+                failures += 1
+                if failures >= len(self.requests):
+                    result['status'] = 'blocked'
+                    result['blocked'] = list(self.requests)
+                    break
+            current_time += quantum
+            iterations += 1
+        result['iterations'] = iterations
+        emit('run_end', policy='round_robin', status=result['status'], processed=processed,
+             blocked=result['blocked'], iterations=iterations)
+        if self.audit:
+            self.audit.record('schedule_run', policy='round_robin', status=result['status'],
+                              processed=len(processed), blocked=len(result['blocked']), iterations=iterations)
+        return result
 
     def process_priority(self):
-        print(Fore.CYAN + "\nProcessing Requests (Priority):" + Style.RESET_ALL)
+        with self.lock:
+            return self._process_priority()
+
+    def _process_priority(self):
+        emit('run_start', policy='priority', queued=len(self.requests))
+        result = {'status': 'done', 'processed': [], 'blocked': []}
         if not self.requests:
-            print(Fore.YELLOW + "No requests to process." + Style.RESET_ALL)
-            return
-        # Create a copy to avoid modifying the original list during sorting
-        requests_copy = self.requests.copy()
-        requests_copy.sort(key=lambda x: x['priority'], reverse=True)
-        processed = []
-        print(f"Initial Request Queue: {[req['id'] for req in requests_copy]} (Priorities: {[req['priority'] for req in requests_copy]})")
-        for request in requests_copy:
-            print(f"Processing request {request['id']} for {request['blood_type']} ({request['units']} units, Priority: {request['priority']})")
+            emit('run_end', policy='priority', status='done', processed=[], blocked=[])
+            return result
+        processed = result['processed']
+        waiting = []
+        while True:
+            entry = self.requests.pop_priority()
+            if entry is None:
+                break
+            ticket, request = entry
             if self.inventory.request_blood(request['blood_type'], request['units']):
+                self.requests.remove(ticket)
                 processed.append((request['id'], request['units'], request['blood_type']))
             else:
-                print(Fore.RED + f"❌ Failed to process request {request['id']} due to insufficient stock." + Style.RESET_ALL)
-        print(f"Processed Requests: {[pid for pid, _, _ in processed]}")
-        return processed
+                waiting.append(ticket)
+        # Requests that could not be served stay queued for the next run
+        for ticket in waiting:
+            self.requests.restore(ticket)
+        if waiting:
+            result['status'] = 'blocked'
+            result['blocked'] = [self.requests.entries[ticket] for ticket in waiting]
+        emit('run_end', policy='priority', status=result['status'], processed=processed, blocked=result['blocked'])
+        if self.audit:
+            self.audit.record('schedule_run', policy='priority', status=result['status'],
+                              processed=len(processed), blocked=len(result['blocked']))
+        return result
+
+    def process_batch(self):
+        with self.lock:
+            return self._process_batch()
+
+    def _process_batch(self):
+        emit('run_start', policy='batch', queued=len(self.requests))
+        result = {'status': 'done', 'processed': [], 'blocked': [], 'substitutions': {}}
+        if not self.requests:
+            emit('run_end', policy='batch', status='done', processed=[], blocked=[])
+            return result
+        # Entries are kept in arrival order, which is the FIFO order within a level
+        tickets = list(self.requests.entries)
+        requests = list(self.requests.entries.values())
+        count = len(requests)
+        units = np.fromiter((req['units'] for req in requests), dtype=np.int64, count=count)
+        recipients = np.fromiter((TYPE_INDEX.get(req['blood_type'], -1) for req in requests), dtype=np.int64, count=count)
+        priorities = np.fromiter((req['priority'] for req in requests), dtype=np.int64, count=count)
+        self.inventory.expire_lots()
+        with self.inventory.locked(BLOOD_TYPES):
+            supply = [self.inventory.available_units(bt) for bt in BLOOD_TYPES]
+            served, drawn = allocate_batch(units, recipients, priorities, supply)
+            self.inventory.dispense_batch({bt: int(drawn[d].sum()) for d, bt in enumerate(BLOOD_TYPES) if drawn[d].any()})
+        processed = result['processed']
+        for i in np.flatnonzero(served):
+            request = requests[i]
+            self.requests.remove(tickets[i])
+            processed.append((request['id'], request['units'], request['blood_type']))
+        result['substitutions'] = {f"{donor}->{recipient}": int(drawn[d, r])
+                                   for d, donor in enumerate(BLOOD_TYPES)
+                                   for r, recipient in enumerate(BLOOD_TYPES) if d != r and drawn[d, r]}
+        if not served.all():
+            result['status'] = 'blocked'
+            result['blocked'] = [requests[i] for i in np.flatnonzero(~served)]
+        emit('run_end', policy='batch', status=result['status'], processed=processed,
+             blocked=result['blocked'], substitutions=result['substitutions'])
+        if self.audit:
+            self.audit.record('schedule_run', policy='batch', status=result['status'], processed=len(processed),
+                              blocked=len(result['blocked']), substituted=sum(result['substitutions'].values()))
+        return result
 
 # Banker's Algorithm class
+# Max demand and allocation are 2-D arrays with one row per process, grown by
+# doubling so add_process stays cheap for large request queues.
 class BankersAlgorithm:
     def __init__(self, total_resources, blood_types):
         self.total_resources = total_resources
-        self.available = total_resources.copy()
+        self.available = np.array(total_resources, dtype=np.int64)
         self.blood_types = blood_types
-        self.allocations = []
-        self.max_demands = []
+        self.count = 0
+        self._max_demands = np.zeros((16, len(blood_types)), dtype=np.int64)
+        self._allocations = np.zeros((16, len(blood_types)), dtype=np.int64)
         self.processes = []
 
+    @classmethod
+    def from_requests(cls, total_resources, blood_types, requests):
+        # Each pending request is a process whose max demand is its units of
+        # one blood type, with nothing allocated yet
+        bankers = cls(total_resources, blood_types)
+        # Requests for types outside the table (e.g. from an old queue) hold
+        # nothing and can't be served, so they are left out
+        type_index = {bt: i for i, bt in enumerate(blood_types)}
+        requests = [req for req in requests if req['blood_type'] in type_index]
+        max_demands = np.zeros((len(requests), len(blood_types)), dtype=np.int64)
+        rows = np.arange(len(requests))
+        columns = np.fromiter((type_index[req['blood_type']] for req in requests), dtype=np.int64, count=len(requests))
+        max_demands[rows, columns] = [req['units'] for req in requests]
+        bankers.add_processes(max_demands, np.zeros_like(max_demands), [req['id'] for req in requests])
+        return bankers
+
+    @property
+    def max_demands(self):
+        return self._max_demands[:self.count]
+
+    @property
+    def allocations(self):
+        return self._allocations[:self.count]
+
+    @property
+    def need(self):
+        return self.max_demands - self.allocations
+
+    def _reserve(self, rows):
+        capacity = len(self._max_demands)
+        if self.count + rows <= capacity:
+            return
+        while capacity < self.count + rows:
+            capacity *= 2
+        for name in ('_max_demands', '_allocations'):
+            grown = np.zeros((capacity, len(self.blood_types)), dtype=np.int64)
+            grown[:self.count] = getattr(self, name)[:self.count]
+            setattr(self, name, grown)
+
     def add_process(self, max_demand, allocation, process_id):
-        self.max_demands.append(max_demand)
-        self.allocations.append(allocation)
-        self.processes.append(process_id)
-        for i in range(len(self.available)):
-            self.available[i] -= allocation[i]
+        self.add_processes([max_demand], [allocation], [process_id])
+        return self.count - 1
+
+    def add_processes(self, max_demands, allocations, process_ids):
+        max_demands = np.asarray(max_demands, dtype=np.int64).reshape(-1, len(self.blood_types))
+        allocations = np.asarray(allocations, dtype=np.int64).reshape(-1, len(self.blood_types))
+        rows = len(max_demands)
+        self._reserve(rows)
+        self._max_demands[self.count:self.count + rows] = max_demands
+        self._allocations[self.count:self.count + rows] = allocations
+        self.count += rows
+        self.processes.extend(process_ids)
+        self.available -= allocations.sum(axis=0)
 
     def is_safe(self):
-        work = self.available[:]
-        finish = [False] * len(self.allocations)
+        # Worklist variant: each column of need is sorted once, and a pointer
+        # per resource advances as work grows. A process becomes runnable when
+        # its need fits in every column; every runnable process is finished in
+        # one vectorized batch. O(n*m*log n) instead of rescanning from 0.
+        n = self.count
+        if n == 0:
+            return True, []
+        need = self.need
+        m = need.shape[1]
+        order = np.argsort(need, axis=0, kind='stable')
+        sorted_need = np.take_along_axis(need, order, axis=0)
+        pointers = np.zeros(m, dtype=np.int64)
+        satisfied = np.zeros(n, dtype=np.int64)
+        work = self.available.copy()
         sequence = []
-
-        while len(sequence) < len(self.allocations):
-            found = False
-            for i in range(len(self.allocations)):
-                if not finish[i]:
-                    if all(self.max_demands[i][j] - self.allocations[i][j] <= work[j] for j in range(len(work))):
-                        sequence.append(i)
-                        finish[i] = True
-                        for j in range(len(work)):
-                            work[j] += self.allocations[i][j]
-                        found = True
-                        break
-            if not found:
-                return False, []
+        while True:
+            ready = []
+            for j in range(m):
+                end = np.searchsorted(sorted_need[:, j], work[j], side='right')
+                if end > pointers[j]:
+                    newly = order[pointers[j]:end, j]
+                    satisfied[newly] += 1
+                    ready.append(newly[satisfied[newly] == m])
+                    pointers[j] = end
+            batch = np.sort(np.concatenate(ready)) if ready else np.empty(0, dtype=np.int64)
+            if batch.size == 0:
+                break
+            sequence.extend(batch.tolist())
+            work += self.allocations[batch].sum(axis=0)
+        if len(sequence) < n:
+            return False, []
         return True, sequence
 
-    def get_state(self):
-        table = []
-        for i, (max_d, alloc, proc_id) in enumerate(zip(self.max_demands, self.allocations, self.processes)):
-            need = [max_d[j] - alloc[j] for j in range(len(max_d))]
-            table.append([proc_id] + alloc + max_d + need)
+    def request_resources(self, index, request):
+        # Classic resource-request check: grant only if the request is within
+        # the process's remaining claim, fits in available, and leaves the
+        # system safe. Otherwise the state is left unchanged.
+        request = np.asarray(request, dtype=np.int64)
+        if (request > self.need[index]).any() or (request > self.available).any():
+            return False
+        self._allocations[index] += request
+        self.available -= request
+        if self.is_safe()[0]:
+            return True
+        self._allocations[index] -= request
+        self.available += request
+        return False
+
+    def release_resources(self, index, release):
+        release = np.minimum(np.asarray(release, dtype=np.int64), self._allocations[index])
+        self._allocations[index] -= release
+        self.available += release
+
+    def admit_process(self, max_demand, process_id):
+        # Admits a new process only if the system stays safe with its claim
+        self.add_process(max_demand, [0] * len(self.blood_types), process_id)
+        if self.is_safe()[0]:
+            return True
+        self.count -= 1
+        self._max_demands[self.count] = 0
+        self.processes.pop()
+        return False
+
+    def get_state(self, limit=None):
+        rows = self.count if limit is None else min(limit, self.count)
+        max_d = self.max_demands[:rows]
+        alloc = self.allocations[:rows]
+        need = max_d - alloc
+        table = [[proc_id] + a + m + nd for proc_id, a, m, nd in
+                 zip(self.processes[:rows], alloc.tolist(), max_d.tolist(), need.tolist())]
         headers = ["Request ID"] + [f"Alloc {bt}" for bt in self.blood_types] + \
                   [f"Max {bt}" for bt in self.blood_types] + [f"Need {bt}" for bt in self.blood_types]
         return table, headers
 
 # Visualizer class
 class Visualizer:
-    def __init__(self, inventory, scheduler, blood_types):
+    def __init__(self, inventory, scheduler, blood_types, max_rows=50):
         self.inventory = inventory
         self.scheduler = scheduler
         self.blood_types = blood_types
+        self.max_rows = max_rows  # Rows shown per queue table
 
     def visualize_bankers(self):
         print(Fore.CYAN + "\n=== Banker's Algorithm State ===" + Style.RESET_ALL)
+        self.inventory.expire_lots()
         total_resources = [self.inventory.blood_stock[bt]['units'] for bt in self.blood_types]
-        bankers = BankersAlgorithm(total_resources, self.blood_types)
-        for req in self.scheduler.requests:
-            max_demand = [0] * len(self.blood_types)
-            allocation = [0] * len(self.blood_types)
-            idx = self.blood_types.index(req['blood_type'])
-            max_demand[idx] = req['units']
-            bankers.add_process(max_demand, allocation, req['id'])
+        bankers = BankersAlgorithm.from_requests(total_resources, self.blood_types, self.scheduler.requests)
         safe, sequence = bankers.is_safe()
-        table, headers = bankers.get_state()
+        table, headers = bankers.get_state(self.max_rows)
         print("Resource Allocation Table:")
         print(tabulate(table, headers=headers, tablefmt="grid"))
+        if bankers.count > len(table):
+            print(f"... and {bankers.count - len(table)} more")
         print("\nAvailable Resources:")
         available_table = [[bt, qty] for bt, qty in zip(self.blood_types, bankers.available)]
         print(tabulate(available_table, headers=["Blood Type", "Available"], tablefmt="grid"))
         if safe:
-            print(Fore.GREEN + f"\n✅ Safe State! Sequence: {[bankers.processes[i] for i in sequence]}" + Style.RESET_ALL)
+            shown = [bankers.processes[i] for i in sequence[:self.max_rows]]
+            more = f" ... (+{len(sequence) - len(shown)} more)" if len(sequence) > len(shown) else ""
+            print(Fore.GREEN + f"\n✅ Safe State! Sequence: {shown}{more}" + Style.RESET_ALL)
         else:
             print(Fore.RED + "\n❌ Unsafe State!" + Style.RESET_ALL)
 
@@ -323,47 +1833,1019 @@ class Visualizer:
         if not self.scheduler.requests:
             print(Fore.YELLOW + "No requests in queue." + Style.RESET_ALL)
             return
-        sorted_requests = sorted(self.scheduler.requests, key=lambda x: x['priority'], reverse=True)
+        top_requests = self.scheduler.requests.ordered(self.max_rows)
         table = [[req['id'], req['blood_type'], req['units'], req['priority']] 
-                 for req in sorted_requests]
+                 for req in top_requests]
         print(tabulate(table, headers=["Request ID", "Blood Type", "Units", "Priority"], tablefmt="grid"))
-        print("\nStock After Processing:")
-        temp_requests = self.scheduler.requests.copy()
-        self.scheduler.requests = sorted_requests
-        processed = self.scheduler.process_priority()
-        self.scheduler.requests = temp_requests
-        stock_table = [[bt, self.inventory.blood_stock[bt]['units']] 
-                       for bt in self.blood_types]
-        print(tabulate(stock_table, headers=["Blood Type", "Units"], tablefmt="grid"))
+        if len(self.scheduler.requests) > len(top_requests):
+            print(f"... and {len(self.scheduler.requests) - len(top_requests)} more")
+        print("\nStock After Processing (simulated):")
+        result = self.simulate('priority')
+        self.print_stock_change(result)
 
     def visualize_round_robin(self):
-        print(Fore.CYAN + "\n=== Round Robin Queue (Quantum: 10s) ===" + Style.RESET_ALL)
+        print(Fore.CYAN + f"\n=== Round Robin Queue (Quantum: {self.scheduler.time_quantum}s) ===" + Style.RESET_ALL)
         if not self.scheduler.requests:
             print(Fore.YELLOW + "No requests in queue." + Style.RESET_ALL)
             return
         table = [[req['id'], req['blood_type'], req['units'], req['priority']] 
-                 for req in self.scheduler.requests]
+                 for req in islice(self.scheduler.requests, self.max_rows)]
         print(tabulate(table, headers=["Request ID", "Blood Type", "Units", "Priority"], tablefmt="grid"))
-        print("\nStock After Processing:")
-        temp_requests = self.scheduler.requests.copy()
-        processed = self.scheduler.process_round_robin()
-        self.scheduler.requests = temp_requests
-        stock_table = [[bt, self.inventory.blood_stock[bt]['units']] 
-                       for bt in self.blood_types]
-        print(tabulate(stock_table, headers=["Blood Type", "Units"], tablefmt="grid"))
+        if len(self.scheduler.requests) > len(table):
+            print(f"... and {len(self.scheduler.requests) - len(table)} more")
+        print("\nStock After Processing (simulated):")
+        result = self.simulate('round_robin')
+        self.print_stock_change(result)
+        processed = result['processed']
         if processed:
             print("\nProcessed Requests:")
-            proc_table = [[pid, units, bt] for pid, units, bt in processed]
+            proc_table = [[pid, units, bt] for pid, units, bt in processed[:self.max_rows]]
             print(tabulate(proc_table, headers=["Request ID", "Units Processed", "Blood Type"], tablefmt="grid"))
+            if len(processed) > len(proc_table):
+                print(f"... and {len(processed) - len(proc_table)} more")
+
+    def simulate(self, policy, **options):
+        # Runs a policy against copy-on-write snapshots of the inventory,
+        # allocator and queue; live stock and requests are left untouched.
+        # Spoiled lots are swept from live stock first, so the difference
+        # between the two is only what the policy dispensed.
+        self.inventory.expire_lots()
+        inventory = self.inventory.fork()
+        scheduler = self.scheduler.fork(inventory)
+        with quiet():
+            if policy == 'round_robin':
+                result = scheduler.process_round_robin(**options)
+            elif policy == 'batch':
+                result = scheduler.process_batch()
+            else:
+                result = scheduler.process_priority()
+        result['policy'] = policy
+        result['stock'] = {bt: inventory.blood_stock[bt]['units'] for bt in self.blood_types}
+        result['dispensed'] = {bt: self.inventory.blood_stock[bt]['units'] - inventory.blood_stock[bt]['units']
+                               for bt in self.blood_types}
+        result['remaining'] = len(scheduler.requests)
+        result['memory'] = inventory.memory_manager.get_memory_status()
+        return result
+
+    def print_stock_change(self, result):
+        stock_table = [[bt, self.inventory.blood_stock[bt]['units'], result['stock'][bt], -result['dispensed'][bt]]
+                       for bt in self.blood_types]
+        print(tabulate(stock_table, headers=["Blood Type", "Units Now", "Units After", "Change"], tablefmt="grid"))
+
+    def compare_policies(self, policies=('priority', 'round_robin', 'batch')):
+        print(Fore.CYAN + "\n=== Policy Comparison (simulated) ===" + Style.RESET_ALL)
+        if not self.scheduler.requests:
+            print(Fore.YELLOW + "No requests in queue." + Style.RESET_ALL)
+            return {}
+        results = {policy: self.simulate(policy) for policy in policies}
+        table = [[policy, result['status'], len(result['processed']), sum(result['dispensed'].values()),
+                  len(result['blocked']), result['remaining']]
+                 for policy, result in results.items()]
+        print(tabulate(table, headers=["Policy", "Status", "Slices Served", "Units Dispensed", "Blocked", "Left In Queue"], tablefmt="grid"))
+        return results
+
+# Persistence
+# Stock lots and the request queue survive restarts. Every allocator and
+# queue change is appended to a write-ahead log, one JSON line per record:
+# [lsn, op, args...]. Appends only buffer the line; a writer thread writes and
+# fsyncs whatever has gathered every sync_interval seconds (group commit), and
+# wait() forces it for callers that must not reply before the change is on
+# disk. Allocator records are physical (block ids and offsets) and are logged
+# under the type lock, frees before their space is released, so recovery
+# rebuilds exactly the same layout. A checkpoint writes a binary snapshot of
+# the block table columns, expiry heaps, free lists and queue, then drops the
+# log it covers; startup maps the snapshot and replays only the log tail.
+class WriteAheadLog:
+    def __init__(self, path, lsn=0, sync_interval=0.005):
+        self.path = path
+        self.lsn = lsn            # last sequence number handed out
+        self.durable_lsn = lsn    # last one known to be on disk
+        self.sync_interval = sync_interval
+        self.buffer = []          # (lsn, line) not yet written
+        self.lock = threading.Lock()     # Guards lsn and the buffer
+        self.io_lock = threading.Lock()  # Serializes writes, fsyncs and truncation
+        self.stopped = threading.Event()
+        self.file = open(path, 'a', encoding='utf-8')
+        self.writer = threading.Thread(target=self._run, name='wal-writer', daemon=True)
+        self.writer.start()
+
+    def append(self, op, *args):
+        with self.lock:
+            self.lsn += 1
+            self.buffer.append((self.lsn, json.dumps([self.lsn, op, *args], separators=(',', ':'))))
+            return self.lsn
+
+    def _run(self):
+        while not self.stopped.wait(self.sync_interval):
+            self.sync()
+
+    def sync(self):
+        with self.io_lock:
+            with self.lock:
+                batch, self.buffer = self.buffer, []
+            if batch:
+                self.file.write(''.join(line + '\n' for _, line in batch))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.durable_lsn = batch[-1][0]
+
+    def wait(self, lsn):
+        if self.durable_lsn < lsn:
+            self.sync()
+
+    def truncate(self, lsn):
+        # Drops every record up to `lsn`, which a snapshot now covers. Records
+        # past it may already be on disk (e.g. ids issued during the
+        # checkpoint), so the tail is copied into a fresh log that replaces
+        # the old one.
+        with self.io_lock:
+            with self.lock:
+                self.buffer = [(n, line) for n, line in self.buffer if n > lsn]
+            self.file.close()
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as file:
+                for n, op, args in read_log(self.path, lsn):
+                    file.write(json.dumps([n, op, *args], separators=(',', ':')) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp, self.path)
+            self.file = open(self.path, 'a', encoding='utf-8')
+            self.durable_lsn = max(self.durable_lsn, lsn)
+
+    def close(self):
+        self.stopped.set()
+        self.writer.join()
+        self.sync()
+        self.file.close()
+
+def read_log(path, after=0):
+    # Yields (lsn, op, args) past `after`; a torn last line ends the log
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                lsn, op, *args = json.loads(line)
+            except ValueError:
+                break
+            if lsn > after:
+                yield lsn, op, args
+
+QUEUE_OPS = {'enqueue', 'dequeue', 'rotate', 'next_id'}
+
+# Snapshot file: magic, 8-byte header length, JSON header, then one raw array
+# per section at 8-byte aligned offsets listed in the header
+SNAPSHOT_MAGIC = b'BBSNAP1\n'
+
+def write_snapshot(path, memory_manager, queue, lsn):
+    blocks = memory_manager.blocks
+    sections = [(name, getattr(blocks, name)) for name, _ in BlockTable.COLUMNS]
+    sections.append(('free_rows', array('q', blocks.free_rows)))
+    for bt in memory_manager.type_names:
+        sections.append((f'heap:{bt}', array('q', memory_manager.blocks_by_type.get(bt, []))))
+    for i, region in enumerate(memory_manager.regions):
+        sections.append((f'free:{i}', array('q', itertools.chain.from_iterable(region.free_by_start.items()))))
+    requests = list(queue.entries.values())
+    request_types = sorted({req['blood_type'] for req in requests})
+    codes = {bt: i for i, bt in enumerate(request_types)}
+    sections += [
+        ('tickets', array('q', list(queue.entries))),
+        ('ids', array('q', [req['id'] for req in requests])),
+        ('types', array('b', [codes[req['blood_type']] for req in requests])),
+        ('units', array('q', [req['units'] for req in requests])),
+        ('priorities', array('q', [int(req['priority']) for req in requests])),
+        ('fifo', array('q', [ticket for ticket in queue.fifo if ticket in queue.entries])),
+    ]
+    header = {
+        'lsn': lsn,
+        'total_capacity': memory_manager.total_capacity,
+        'regions': len(memory_manager.regions),
+        'region_used': [region.used for region in memory_manager.regions],
+        'type_names': memory_manager.type_names,
+        'used_by_type': memory_manager.used_by_type,
+        'live': blocks.live,
+        'request_types': request_types,
+        'next_ticket': queue.next_ticket,
+        'next_id': queue.next_id,
+        'sections': {},
+    }
+    offset = 0
+    for name, column in sections:
+        header['sections'][name] = (column.typecode, offset, len(column))
+        offset += -(-len(column) * column.itemsize // 8) * 8
+    head = json.dumps(header).encode()
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as file:
+        file.write(SNAPSHOT_MAGIC + len(head).to_bytes(8, 'little') + head)
+        file.write(bytes(-file.tell() % 8))
+        for _, column in sections:
+            file.write(column.tobytes())
+            file.write(bytes(-file.tell() % 8))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+
+def load_snapshot(path, aging_rate=0):
+    # Returns (memory manager, request queue, lsn). Columns are copied
+    # straight out of the mapped file; only heaps, free lists and queue
+    # entries become Python objects.
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if mapped[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a snapshot")
+        size = int.from_bytes(mapped[len(SNAPSHOT_MAGIC):len(SNAPSHOT_MAGIC) + 8], 'little')
+        start = len(SNAPSHOT_MAGIC) + 8
+        header = json.loads(mapped[start:start + size])
+        base = -(-(start + size) // 8) * 8
+        with memoryview(mapped) as view:
+            columns = {}
+            for name, (typecode, offset, count) in header['sections'].items():
+                column = array(typecode)
+                column.frombytes(view[base + offset:base + offset + count * column.itemsize])
+                columns[name] = column
+
+    memory_manager = MemoryManager(header['total_capacity'], regions=header['regions'])
+    blocks = memory_manager.blocks
+    for name, _ in BlockTable.COLUMNS:
+        setattr(blocks, name, columns[name])
+    blocks.free_rows = columns['free_rows'].tolist()
+    blocks.live = header['live']
+    memory_manager.type_names = header['type_names']
+    memory_manager.type_codes = {bt: code for code, bt in enumerate(header['type_names'])}
+    memory_manager.blocks_by_type = {bt: columns[f'heap:{bt}'].tolist() for bt in header['type_names']}
+    memory_manager.used_by_type = header['used_by_type']
+    for i, region in enumerate(memory_manager.regions):
+        pairs = columns[f'free:{i}']
+        region.free_by_start = dict(zip(pairs[0::2], pairs[1::2]))
+        region.rebuild_index()
+        region.used = header['region_used'][i]
+
+    queue = RequestQueue(aging_rate)
+    names = header['request_types']
+    queue.entries = {ticket: {'id': request_id, 'blood_type': names[code], 'units': units, 'priority': priority}
+                     for ticket, request_id, code, units, priority in zip(
+                         columns['tickets'].tolist(), columns['ids'].tolist(), columns['types'].tolist(),
+                         columns['units'].tolist(), columns['priorities'].tolist())}
+    queue.fifo = deque(columns['fifo'].tolist())
+    queue.next_ticket = header['next_ticket']
+    queue.next_id = header['next_id']
+    return memory_manager, queue, header['lsn']
+
+class PersistentStore:
+    def __init__(self, directory='bank_state', sync_interval=0.005, snapshot_every=100000, check_interval=1.0):
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, 'snapshot.bin')
+        self.log_path = os.path.join(directory, 'wal.jsonl')
+        self.sync_interval = sync_interval
+        self.snapshot_every = snapshot_every  # Log records that trigger a checkpoint
+        self.check_interval = check_interval
+        self.checkpoint_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.wal = None
+        self.inventory = None
+        self.scheduler = None
+        self.snapshot_lsn = 0
+        self.recovery = {}
+
+    def open(self, total_capacity=1000, regions=1, time_quantum=10, aging_rate=0, audit=None):
+        # Loads the latest snapshot, replays the log after it and returns a
+        # (inventory, scheduler) pair that logs every change from here on.
+        # Capacity and regions only apply to a fresh store.
+        os.makedirs(self.directory, exist_ok=True)
+        start = time.perf_counter()
+        if not os.path.exists(self.snapshot_path):
+            # A fresh store records its layout before anything is logged, so
+            # a crash before the first checkpoint still recovers it
+            write_snapshot(self.snapshot_path, MemoryManager(total_capacity, regions=regions), RequestQueue(aging_rate), 0)
+        memory_manager, queue, lsn = load_snapshot(self.snapshot_path, aging_rate)
+        self.snapshot_lsn = lsn
+        loaded = time.perf_counter()
+        replayed = 0
+        for lsn, op, args in read_log(self.log_path, lsn):
+            (queue if op in QUEUE_OPS else memory_manager).redo(op, *args)
+            replayed += 1
+        queue.rebuild_heap()
+        # The log is attached before anything else touches the state, so
+        # even the lazy heap cleanup below is logged
+        self.wal = WriteAheadLog(self.log_path, max(lsn, self.snapshot_lsn), self.sync_interval)
+        memory_manager.wal = queue.wal = self.wal
+        memory_manager.audit = audit
+        inventory = BloodInventory(memory_manager, audit=audit)
+        inventory.refresh_stock()
+        scheduler = Scheduler(inventory, time_quantum, aging_rate, audit=audit)
+        scheduler.requests = queue
+        self.inventory, self.scheduler = inventory, scheduler
+        self.recovery = {'snapshot_lsn': self.snapshot_lsn, 'replayed': replayed, 'lots': len(memory_manager.blocks),
+                         'requests': len(queue), 'load_seconds': loaded - start,
+                         'replay_seconds': time.perf_counter() - loaded}
+        threading.Thread(target=self._run, name='checkpointer', daemon=True).start()
+        atexit.register(self.close)
+        return inventory, scheduler
+
+    def _run(self):
+        while not self.stopped.wait(self.check_interval):
+            if self.wal.lsn - self.snapshot_lsn >= self.snapshot_every:
+                self.checkpoint()
+
+    def checkpoint(self):
+        # Pauses the bank while the snapshot is written, then drops the log
+        # records it covers
+        with self.checkpoint_lock, self.scheduler.lock, self.inventory.locked(self.inventory.blood_stock):
+            lsn = self.wal.lsn
+            write_snapshot(self.snapshot_path, self.inventory.memory_manager, self.scheduler.requests, lsn)
+            self.wal.truncate(lsn)
+            self.snapshot_lsn = lsn
+        return lsn
+
+    def close(self):
+        if self.wal is None or self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.checkpoint()
+        self.wal.close()
+
+# Headless replay engine
+# Streams events through the inventory and scheduler without any console I/O
+# and yields one structured result record per event. Events are JSON objects:
+#   {"op": "donate", "blood_type": "A+", "units": 5, "time": "...", "expiry": "..."}
+#   {"op": "request", "blood_type": "O-", "units": 2, "priority": 7, "id": 12}
+#   {"op": "dispense", "blood_type": "O-", "units": 2}
+#   {"op": "schedule", "policy": "priority" | "round_robin" | "batch", "time_quantum": 10, "max_iterations": 1000}
+#   {"op": "expire"}
+# "time" (ISO format) is optional on any event and drives the inventory clock,
+# so lots expire relative to the replayed day rather than the wall clock.
+def read_events(path):
+    file = sys.stdin if path == '-' else open(path, 'r', encoding='utf-8')
+    try:
+        # Lines are parsed by ReplayEngine.run, so one torn or malformed
+        # line fails on its own instead of ending the replay
+        for line in file:
+            if line.strip():
+                yield line
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+class ReplayEngine:
+    def __init__(self, inventory, scheduler):
+        self.inventory = inventory
+        self.scheduler = scheduler
+        self.now = None
+        self.next_request_id = 1
+        self.inventory.clock = lambda: self.now or datetime.now()
+
+    def run(self, events):
+        handlers = {
+            'donate': self._donate,
+            'request': self._request,
+            'dispense': self._dispense,
+            'schedule': self._schedule,
+            'expire': self._expire,
+        }
+        for seq, event in enumerate(events):
+            op = None
+            try:
+                if isinstance(event, str):
+                    event = json.loads(event)
+                if not isinstance(event, dict):
+                    raise TypeError(f"event must be an object, not {type(event).__name__}")
+                op = event.get('op')
+                if 'time' in event:
+                    self.now = datetime.fromisoformat(event['time'])
+                handler = handlers.get(op)
+                record = handler(event) if handler else {'ok': False, 'error': 'unknown op'}
+            except (KeyError, TypeError, ValueError) as e:
+                record = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+            record['seq'] = seq
+            record['op'] = op
+            yield record
+
+    def _donate(self, event):
+        expiry = datetime.fromisoformat(event['expiry']) if event.get('expiry') else None
+        return {'ok': self.inventory.donate_blood(event['blood_type'], int(event['units']), expiry)}
+
+    def _request(self, event):
+        request_id = event.get('id', self.next_request_id)
+        self.next_request_id = max(self.next_request_id, request_id + 1) if isinstance(request_id, int) else self.next_request_id + 1
+        ok = self.scheduler.add_request({'id': request_id, 'blood_type': event['blood_type'],
+                                         'units': int(event['units']), 'priority': int(event.get('priority', 1))})
+        return {'ok': ok, 'id': request_id, 'queued': len(self.scheduler.requests)}
+
+    def _dispense(self, event):
+        return {'ok': self.inventory.request_blood(event['blood_type'], int(event['units']))}
+
+    def _schedule(self, event):
+        if event.get('policy', 'priority') == 'round_robin':
+            result = self.scheduler.process_round_robin(event.get('time_quantum'), event.get('max_iterations'))
+        elif event.get('policy') == 'batch':
+            result = self.scheduler.process_batch()
+        else:
+            result = self.scheduler.process_priority()
+        return {'ok': True, 'policy': event.get('policy', 'priority'), 'status': result['status'],
+                'processed': len(result['processed']), 'blocked': len(result['blocked']),
+                'queued': len(self.scheduler.requests)}
+
+    def _expire(self, event):
+        return {'ok': True, 'expired': self.inventory.expire_lots()}
+
+def replay(events_path, output_path='-', total_capacity=1000, time_quantum=10, aging_rate=0):
+    # Python API behind the `replay` subcommand; returns a summary dict
+    with quiet():
+        memory_manager = MemoryManager(total_capacity)
+        inventory = BloodInventory(memory_manager)
+        scheduler = Scheduler(inventory, time_quantum, aging_rate)
+        engine = ReplayEngine(inventory, scheduler)
+        out = sys.stdout if output_path == '-' else open(output_path, 'w', encoding='utf-8')
+        summary = {'events': 0, 'failed': 0}
+        start = time.perf_counter()
+        try:
+            for record in engine.run(read_events(events_path)):
+                summary['events'] += 1
+                if not record['ok']:
+                    summary['failed'] += 1
+                out.write(json.dumps(record) + '\n')
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        summary['elapsed'] = time.perf_counter() - start
+        summary['per_second'] = summary['events'] / summary['elapsed'] if summary['elapsed'] else 0.0
+        summary['stock'] = {bt: details['units'] for bt, details in inventory.blood_stock.items()}
+        summary['memory'] = memory_manager.get_memory_status()
+        summary['queued'] = len(scheduler.requests)
+        return summary
+
+# Instrumentation
+# Metrics are opt-in: instrument() swaps timed wrappers in for the named
+# methods on an object (or class), so nothing on the hot paths checks whether
+# metrics are on. Latencies go into fixed-bucket histograms, calls and
+# failures (a False or None result) into counters, and gauges are read only
+# when a snapshot or scrape asks for them.
+LATENCY_BUCKETS = tuple(float(f"{m}e{e}") for e in range(-6, 1) for m in (1, 2.5, 5)) + (10.0,)
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        rank = q * self.count
+        for bound, seen in zip(self.bounds + (float('inf'),), itertools.accumulate(self.counts)):
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class SamplingProfiler:
+    # Samples the innermost frame of the thread running a scheduler pass
+    # every `interval` seconds from a helper thread. One run at a time; a run
+    # that starts while another is being sampled is not profiled.
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.samples = {}  # "function (file:line)" -> count
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        if self.thread is not None:
+            return False
+        target = threading.get_ident()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, args=(target,), name='sampling-profiler', daemon=True)
+        self.thread.start()
+        return True
+
+    def _run(self, target):
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            if frame is not None:
+                code = frame.f_code
+                key = f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def top(self, limit=10):
+        return sorted(self.samples.items(), key=lambda item: -item[1])[:limit]
+
+class Metrics:
+    def __init__(self, prefix='bloodbank', profiler=None):
+        self.prefix = prefix
+        self.profiler = profiler
+        self.lock = threading.Lock()
+        self.latency = {}   # op -> Histogram
+        self.counters = {}  # (name, op) -> value
+        self.gauges = {}    # name -> (read, label); read() returns a number, or {label value: number}
+        self.patched = []   # (target, method name) to undo
+
+    def inc(self, name, op, value=1):
+        with self.lock:
+            self.counters[name, op] = self.counters.get((name, op), 0) + value
+
+    def gauge(self, name, read, label=None):
+        self.gauges[name] = (read, label)
+
+    def _timed(self, op, method, profile):
+        histogram = self.latency.setdefault(op, Histogram())
+        clock = time.perf_counter
+
+        def timed(*args, **kwargs):
+            profiling = profile and self.profiler is not None and self.profiler.start()
+            start = clock()
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                elapsed = clock() - start
+                if profiling:
+                    self.profiler.stop()
+                with self.lock:
+                    histogram.observe(elapsed)
+                    self.counters['calls', op] = self.counters.get(('calls', op), 0) + 1
+            if result is False or result is None:
+                self.inc('failures', op)
+            return result
+        return timed
+
+    def instrument(self, target, *names, profile=False):
+        for name in names:
+            original = target.__dict__.get(name) if isinstance(target, type) else None
+            setattr(target, name, self._timed(name, getattr(target, name), profile))
+            self.patched.append((target, name, original))
+
+    def restore(self):
+        for target, name, original in reversed(self.patched):
+            if isinstance(target, type):
+                setattr(target, name, original)
+            else:
+                delattr(target, name)
+        self.patched = []
+
+    def read_gauges(self):
+        return {name: read() for name, (read, _) in self.gauges.items()}
+
+    def snapshot(self):
+        with self.lock:
+            latency = {op: {'count': h.count, 'sum': h.sum, 'p50': h.quantile(0.5), 'p99': h.quantile(0.99)}
+                       for op, h in self.latency.items() if h.count}
+            counters = {}
+            for (name, op), value in self.counters.items():
+                counters.setdefault(name, {})[op] = value
+        snapshot = {'latency_seconds': latency, 'counters': counters, 'gauges': self.read_gauges()}
+        if self.profiler is not None:
+            snapshot['profile'] = self.profiler.top()
+        return snapshot
+
+    def prometheus(self):
+        # Prometheus text exposition format, version 0.0.4
+        prefix = self.prefix
+        lines = [f"# TYPE {prefix}_op_seconds histogram"]
+        with self.lock:
+            for op, h in self.latency.items():
+                for bound, seen in zip(h.bounds + ('+Inf',), itertools.accumulate(h.counts)):
+                    lines.append(f'{prefix}_op_seconds_bucket{{op="{op}",le="{bound}"}} {seen}')
+                lines.append(f'{prefix}_op_seconds_sum{{op="{op}"}} {h.sum}')
+                lines.append(f'{prefix}_op_seconds_count{{op="{op}"}} {h.count}')
+            counters = sorted(self.counters.items())
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f"# TYPE {prefix}_op_{name}_total counter")
+            lines.extend(f'{prefix}_op_{name}_total{{op="{op}"}} {value}' for (n, op), value in counters if n == name)
+        for name, value in self.read_gauges().items():
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            label = self.gauges[name][1]
+            if label:
+                lines.extend(f'{prefix}_{name}{{{label}="{key}"}} {v}' for key, v in value.items())
+            else:
+                lines.append(f"{prefix}_{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+def instrument_bank(metrics, inventory, scheduler):
+    # Standard wiring: hot paths, scheduler runs (profiled) and gauges
+    metrics.instrument(inventory, 'donate_blood', 'request_blood')
+    # The inventory calls the allocator's internals under its own type locks,
+    # so those are what gets timed; the public wrappers go through them too
+    metrics.instrument(inventory.memory_manager, 'allocate_block', '_deallocate', '_release_expired')
+    metrics.instrument(scheduler, 'process_round_robin', 'process_priority', 'process_batch', profile=True)
+    metrics.instrument(BankersAlgorithm, 'is_safe')
+    memory_manager = inventory.memory_manager
+    metrics.gauge('queue_depth', lambda: len(scheduler.requests))
+    metrics.gauge('stock_units', lambda: {bt: inventory.blood_stock[bt]['units'] for bt in BLOOD_TYPES}, 'blood_type')
+    metrics.gauge('storage_used_units', lambda: memory_manager.used_space)
+    metrics.gauge('storage_capacity_units', lambda: memory_manager.total_capacity)
+    metrics.gauge('fragmentation_ratio', lambda: memory_manager.get_fragmentation_stats()['external_fragmentation'])
+    return metrics
+
+def serve_metrics(metrics, host='127.0.0.1', port=9100):
+    # Serves /metrics (Prometheus text) and /metrics.json from a daemon thread
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = metrics.prometheus().encode(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, content_type = json.dumps(metrics.snapshot()).encode(), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+# Service front-end
+# asyncio server speaking JSON lines on a local socket:
+#   {"op": "donate", "blood_type": "A+", "units": 5}          -> {"ok": true}
+#   {"op": "request", "blood_type": "A+", "units": 2, "priority": 5}
+#       -> {"ok": true, "id": 7, "status": "served" | "queued"}
+#   {"op": "status"}                                          -> stock and queue depth
+# Donations run on a thread pool straight against the inventory, where the
+# per-type locks keep different blood types independent. Requests are
+# collected and fed to the scheduler in batches every batch_interval seconds.
+class BloodBankService:
+    def __init__(self, inventory, scheduler, batch_interval=0.005, workers=None):
+        self.inventory = inventory
+        self.scheduler = scheduler
+        self.batch_interval = batch_interval
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = []    # (request, future) waiting for the next batch
+        self.server = None
+        self.batcher = None
+
+    async def start(self, host='127.0.0.1', port=8765):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.batcher = asyncio.create_task(self.batch_loop())
+        return self.server
+
+    async def stop(self):
+        self.batcher.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+        self.executor.shutdown()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    reply = await self.dispatch(json.loads(line))
+                except (KeyError, TypeError, ValueError) as e:
+                    reply = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, message):
+        loop = asyncio.get_running_loop()
+        op = message['op']
+        if op == 'donate':
+            ok = await loop.run_in_executor(self.executor, self._donate, message['blood_type'], int(message['units']))
+            return {'ok': ok}
+        if op == 'request':
+            blood_type, units, priority = message['blood_type'], int(message['units']), int(message.get('priority', 1))
+            if blood_type not in self.inventory.blood_stock or not 0 < units <= self.inventory.memory_manager.total_capacity:
+                return {'ok': False, 'error': "invalid blood type or units"}
+            if not 1 <= priority <= 10:
+                return {'ok': False, 'error': "priority must be between 1 and 10"}
+            request = {'id': self.scheduler.next_request_id(), 'blood_type': blood_type, 'units': units, 'priority': priority}
+            future = loop.create_future()
+            self.pending.append((request, future))
+            return await future
+        if op == 'status':
+            return {'ok': True, 'stock': {bt: self.inventory.available_units(bt) for bt in self.inventory.blood_stock},
+                    'queued': len(self.scheduler.requests)}
+        return {'ok': False, 'error': f"unknown op {op!r}"}
+
+    def _durable(self):
+        # With a persistent store, replies wait for their changes to be on
+        # disk; concurrent callers share one fsync
+        wal = self.scheduler.requests.wal
+        if wal:
+            wal.wait(wal.lsn)
+
+    def _donate(self, blood_type, units):
+        ok = self.inventory.donate_blood(blood_type, units)
+        self._durable()
+        return ok
+
+    def _run_batch(self, requests):
+        try:
+            with self.scheduler.lock:
+                tickets = [self.scheduler.requests.append(request) for request in requests]
+                try:
+                    return self.scheduler.process_batch()
+                except Exception:
+                    # A batch that breaks the run is dropped, or it would
+                    # break every run after it
+                    for ticket in tickets:
+                        self.scheduler.requests.remove(ticket)
+                    raise
+        finally:
+            self._durable()
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.batch_interval)
+            if not self.pending:
+                continue
+            batch, self.pending = self.pending, []
+            try:
+                result = await loop.run_in_executor(self.executor, self._run_batch, [request for request, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result({'ok': False, 'error': f"{type(e).__name__}: {e}"})
+                continue
+            served = {request_id for request_id, _, _ in result['processed']}
+            for request, future in batch:
+                if not future.done():
+                    status = 'served' if request['id'] in served else 'queued'
+                    future.set_result({'ok': True, 'id': request['id'], 'status': status})
+
+def serve(host='127.0.0.1', port=8765, total_capacity=100000, regions=8, batch_interval=0.005, metrics_port=None,
+          event_log=None, state_dir=None):
+    set_sink(JsonlSink(event_log) if event_log else NullSink())
+    store = PersistentStore(state_dir) if state_dir else None
+    if store:
+        inventory, scheduler = store.open(total_capacity, regions)
+    else:
+        inventory = BloodInventory(MemoryManager(total_capacity, regions=regions))
+        scheduler = Scheduler(inventory)
+    service = BloodBankService(inventory, scheduler, batch_interval)
+    if metrics_port is not None:
+        metrics = instrument_bank(Metrics(profiler=SamplingProfiler()), inventory, service.scheduler)
+        serve_metrics(metrics, host, metrics_port)
+
+    async def run():
+        server = await service.start(host, port)
+        print(f"Serving on {', '.join(str(sock.getsockname()) for sock in server.sockets)}", file=sys.stderr, flush=True)
+        try:
+            await server.serve_forever()
+        finally:
+            await service.stop()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if store:
+            store.close()
+        set_sink(NullSink()).close()
+
+# Sharded multi-site mode
+# Each site runs its own allocator, inventory and scheduler in a worker
+# process. A ShardRouter in the parent buffers donations and requests per site
+# and ships them in one message per site, so IPC is paid per batch rather
+# than per operation. Commands go out to every site before any reply is read,
+# which lets the shards work in parallel. Messages are (op, payload) tuples
+# over a Pipe; see site_worker for the ops.
+def site_summary(inventory, result):
+    # Units of each request left blocked, per type, and what is still free
+    needs = {}
+    for request in result['blocked']:
+        needs.setdefault(request['blood_type'], []).append(request['units'])
+    return {
+        'status': result['status'],
+        'processed': len(result['processed']),
+        'units': sum(units for _, units, _ in result['processed']),
+        'blocked': len(result['blocked']),
+        'needs': needs,
+        'stock': {bt: inventory.available_units(bt) for bt in BLOOD_TYPES},
+    }
+
+def site_worker(conn, total_capacity, regions, time_quantum):
+    set_quiet(True)
+    inventory = BloodInventory(MemoryManager(total_capacity, regions=regions))
+    scheduler = Scheduler(inventory, time_quantum)
+    policies = {'batch': scheduler.process_batch, 'priority': scheduler.process_priority,
+                'round_robin': scheduler.process_round_robin}
+    while True:
+        op, payload = conn.recv()
+        if op == 'close':
+            break
+        if op == 'donate':
+            reply = sum(inventory.donate_blood(bt, units) for bt, units in payload)
+        elif op == 'request':
+            for request in payload:
+                scheduler.add_request(request)
+            reply = len(scheduler.requests)
+        elif op == 'schedule':
+            reply = site_summary(inventory, policies[payload]())
+        elif op == 'stock':
+            inventory.expire_lots()
+            reply = {bt: inventory.available_units(bt) for bt in BLOOD_TYPES}
+        elif op == 'transfer_out':
+            # Units are only reserved here and leave once the destination has
+            # stocked them (transfer_settle). They travel with the earliest
+            # expiry of their type, which is conservative for everything
+            # dispensed after the first lot.
+            reply = []
+            for bt, units in payload:
+                # Swept first, or the cached expiry may be a lot that spoiled
+                inventory.expire_lots(bt)
+                expiry = inventory.blood_stock[bt]['expiry']
+                token = inventory.reserve(bt, units)
+                reply.append((token, (bt, units, expiry)) if token is not None else None)
+        elif op == 'transfer_in':
+            reply = [inventory.donate_blood(bt, units, expiry) for bt, units, expiry in payload]
+        elif op == 'transfer_settle':
+            # (token, delivered) pairs: delivered units are dispensed, the
+            # rest go back to available stock
+            reply = [inventory.commit(token) if delivered else inventory.cancel(token) for token, delivered in payload]
+        else:
+            reply = None
+        conn.send(reply)
+    conn.close()
+
+def plan_transfers(needs, stock):
+    # Proposes (source, destination, blood type, units) moves for the
+    # requests each site left blocked, from the sites with the most surplus,
+    # trying the exact type before compatible substitutes. needs maps site ->
+    # {type: [units per blocked request]} and stock maps site -> {type: free
+    # units}; a site's surplus is its free stock less its own shortfall.
+    # Requests are all-or-nothing, so a request only gets moves when its own
+    # free stock and the moves together cover it in full.
+    free = {site: dict(units) for site, units in stock.items()}
+    surplus = {site: {bt: max(0, units - sum(needs.get(site, {}).get(bt, []))) for bt, units in units_by_type.items()}
+               for site, units_by_type in stock.items()}
+    moves = []
+    for site, shortfall in needs.items():
+        for recipient, requests in shortfall.items():
+            donors = [recipient] + SUBSTITUTES[recipient]
+            for units in requests:
+                local, planned = {}, []
+                for donor in donors:
+                    take = min(free[site].get(donor, 0) - local.get(donor, 0), units)
+                    if take > 0:
+                        local[donor] = local.get(donor, 0) + take
+                        units -= take
+                drawn = {}
+                for donor in donors:
+                    if units <= 0:
+                        break
+                    sources = sorted((surplus[other][donor] - drawn.get((other, donor), 0), other)
+                                     for other in surplus if other != site)
+                    while units > 0 and sources and sources[-1][0] > 0:
+                        available, source = sources.pop()
+                        take = min(available, units)
+                        drawn[source, donor] = drawn.get((source, donor), 0) + take
+                        units -= take
+                        planned.append((source, site, donor, take))
+                if units > 0:
+                    continue
+                for donor, take in local.items():
+                    free[site][donor] -= take
+                    surplus[site][donor] = min(surplus[site][donor], free[site][donor])
+                for (source, donor), take in drawn.items():
+                    surplus[source][donor] -= take
+                    free[source][donor] -= take
+                moves += planned
+    return moves
+
+class ShardRouter:
+    def __init__(self, sites, total_capacity=1000, regions=1, time_quantum=10):
+        self.sites = list(sites)
+        self.request_ids = itertools.count(1)
+        self.pending = {site: {'donate': [], 'request': []} for site in self.sites}
+        self.conns = {}
+        self.workers = {}
+        for site in self.sites:
+            parent, child = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=site_worker, args=(child, total_capacity, regions, time_quantum),
+                                             name=f"site-{site}", daemon=True)
+            worker.start()
+            child.close()
+            self.conns[site] = parent
+            self.workers[site] = worker
+
+    def _broadcast(self, messages):
+        # Sends every site its message first, then collects the replies
+        for site, message in messages.items():
+            self.conns[site].send(message)
+        return {site: self.conns[site].recv() for site in messages}
+
+    def donate(self, site, blood_type, units):
+        self.pending[site]['donate'].append((blood_type, units))
+
+    def add_request(self, site, request):
+        # Checked here as well as at the site, since the planner reads the
+        # blocked requests' types. Returns the request id, or None if invalid.
+        request = dict(request)
+        request.setdefault('id', next(self.request_ids))
+        request.setdefault('priority', 1)
+        if request['blood_type'] not in TYPE_INDEX:
+            emit('queued', ok=False, id=request['id'], blood_type=request['blood_type'], units=request['units'], reason='invalid_type')
+            return None
+        if request['units'] <= 0:
+            emit('queued', ok=False, id=request['id'], blood_type=request['blood_type'], units=request['units'], reason='invalid_units')
+            return None
+        self.pending[site]['request'].append(request)
+        return request['id']
+
+    def flush(self):
+        for op in ('donate', 'request'):
+            messages = {site: (op, ops[op]) for site, ops in self.pending.items() if ops[op]}
+            if messages:
+                self._broadcast(messages)
+            for ops in self.pending.values():
+                ops[op] = []
+
+    def stock(self):
+        self.flush()
+        return self._broadcast({site: ('stock', None) for site in self.sites})
+
+    def transfer(self, moves):
+        # Reserve-then-commit across sites: units are reserved at the
+        # sources, stocked at the destinations with their expiry, and only
+        # then dispensed at the sources. A lot the destination has no room
+        # for is released at its source. Returns the moves that were made.
+        self.flush()
+        outgoing = {}
+        for move in moves:
+            outgoing.setdefault(move[0], []).append(move)
+        reserved = self._broadcast({site: ('transfer_out', [(bt, units) for _, _, bt, units in items])
+                                    for site, items in outgoing.items()})
+        deliveries = {}
+        for site, items in outgoing.items():
+            for move, held in zip(items, reserved[site]):
+                if held is not None:
+                    deliveries.setdefault(move[1], []).append((move, *held))
+        if not deliveries:
+            return []
+        stocked = self._broadcast({site: ('transfer_in', [lot for _, _, lot in items]) for site, items in deliveries.items()})
+        made, settle = [], {}
+        for site, items in deliveries.items():
+            for (move, token, _), ok in zip(items, stocked[site]):
+                settle.setdefault(move[0], []).append((token, ok))
+                if ok:
+                    made.append(move)
+        self._broadcast({site: ('transfer_settle', tokens) for site, tokens in settle.items()})
+        return made
+
+    def process(self, policy='batch', rebalance=True):
+        # Runs every site's scheduler in parallel. With rebalance, shortfalls
+        # are covered by planned transfers and the short sites run again.
+        self.flush()
+        summaries = self._broadcast({site: ('schedule', policy) for site in self.sites})
+        moves = []
+        if rebalance:
+            needs = {site: summary['needs'] for site, summary in summaries.items() if summary['needs']}
+            planned = plan_transfers(needs, {site: summary['stock'] for site, summary in summaries.items()})
+            if planned:
+                moves = self.transfer(planned)
+                rerun = {destination for _, destination, _, _ in moves}
+                for site, summary in self._broadcast({site: ('schedule', policy) for site in rerun}).items():
+                    summary['processed'] += summaries[site]['processed']
+                    summary['units'] += summaries[site]['units']
+                    summaries[site] = summary
+        return {'sites': summaries, 'transfers': moves}
+
+    def close(self):
+        for site in self.sites:
+            try:
+                self.conns[site].send(('close', None))
+            except (BrokenPipeError, OSError):
+                pass
+            self.conns[site].close()
+        for worker in self.workers.values():
+            worker.join(timeout=5)
 
 # Main function
-def main():
+def main(metrics_port=None, state_dir='bank_state'):
     admin_system = Admin()
-    memory_manager = MemoryManager()
-    inventory = BloodInventory(memory_manager)
-    blood_types = ['A+', 'A-', 'B+', 'B-', 'AB+', 'AB-', 'O+', 'O-']
-    scheduler = Scheduler(inventory)
+    audit = admin_system.audit_log
+    donor_system = Donor()
+    store = PersistentStore(state_dir)
+    inventory, scheduler = store.open(audit=audit)
+    memory_manager = inventory.memory_manager
+    blood_types = list(BLOOD_TYPES)
     visualizer = Visualizer(inventory, scheduler, blood_types)
+    # Instrumenting wraps hot methods and starts the profiler thread, so it
+    # waits for --metrics-port or the first look at admin option 10
+    metrics = None
+    if metrics_port is not None:
+        metrics = instrument_bank(Metrics(profiler=SamplingProfiler()), inventory, scheduler)
+        serve_metrics(metrics, port=metrics_port)
 
     while True:
         clear_screen()
@@ -393,7 +2875,6 @@ def main():
             print(Fore.CYAN + "\n=== Donor Registration ===" + Style.RESET_ALL)
             username = input("Enter username: ").strip()
             password = input("Enter password: ").strip()
-            donor_system = Donor()
             donor_system.register(username, password)
         elif choice == '4':
             try:
@@ -401,10 +2882,14 @@ def main():
                 blood_type = input("Enter blood type (e.g., A+, O-): ").strip().upper()
                 units = int(input("Enter number of units: "))
                 priority = int(input("Enter priority (1-10): "))
-                if priority < 1 or priority > 10:
+                if blood_type not in BLOOD_TYPES:
+                    print(Fore.RED + "❌ Invalid blood type!" + Style.RESET_ALL)
+                elif units <= 0:
+                    print(Fore.RED + "❌ Units must be positive!" + Style.RESET_ALL)
+                elif priority < 1 or priority > 10:
                     print(Fore.RED + "❌ Priority must be between 1 and 10!" + Style.RESET_ALL)
                 else:
-                    scheduler.add_request({'id': len(scheduler.requests) + 1, 'blood_type': blood_type, 'units': units, 'priority': priority})
+                    scheduler.add_request({'id': scheduler.next_request_id(), 'blood_type': blood_type, 'units': units, 'priority': priority})
             except ValueError:
                 print(Fore.RED + "❌ Invalid input! Units and priority must be numbers." + Style.RESET_ALL)
         elif choice == '5':
@@ -421,6 +2906,10 @@ def main():
                     4. Run Banker's Algorithm
                     5. Logout
                     6. Visualize Algorithms
+                    7. Import Donors (CSV/JSONL)
+                    8. View Audit Log
+                    9. Process Requests (Batch, compatibility-aware)
+                    10. View Metrics (JSON)
                     """ + Style.RESET_ALL)
                     admin_choice = input(Fore.YELLOW + "Enter your choice: " + Style.RESET_ALL)
                     if admin_choice == '1':
@@ -430,19 +2919,17 @@ def main():
                     elif admin_choice == '3':
                         memory_status = memory_manager.get_memory_status()
                         print(f"Memory Status: {memory_status}")
+                        print(f"Fragmentation: {memory_manager.get_fragmentation_stats()}")
                     elif admin_choice == '4':
                         print(Fore.YELLOW + "Running Banker's Algorithm..." + Style.RESET_ALL)
+                        inventory.expire_lots()
                         total_resources = [inventory.blood_stock[bt]['units'] for bt in blood_types]
-                        bankers = BankersAlgorithm(total_resources, blood_types)
-                        for req in scheduler.requests:
-                            max_demand = [0] * len(blood_types)
-                            allocation = [0] * len(blood_types)
-                            idx = blood_types.index(req['blood_type'])
-                            max_demand[idx] = req['units']
-                            bankers.add_process(max_demand, allocation, req['id'])
+                        bankers = BankersAlgorithm.from_requests(total_resources, blood_types, scheduler.requests)
                         safe, sequence = bankers.is_safe()
                         if safe:
-                            print(Fore.GREEN + f"✅ System is in a safe state! Sequence: {[bankers.processes[i] for i in sequence]}" + Style.RESET_ALL)
+                            shown = [bankers.processes[i] for i in sequence[:20]]
+                            more = f" ... (+{len(sequence) - len(shown)} more)" if len(sequence) > len(shown) else ""
+                            print(Fore.GREEN + f"✅ System is in a safe state! Sequence: {shown}{more}" + Style.RESET_ALL)
                         else:
                             print(Fore.RED + "❌ System is not in a safe state!" + Style.RESET_ALL)
                     elif admin_choice == '5':
@@ -453,17 +2940,84 @@ def main():
                         visualizer.visualize_bankers()
                         visualizer.visualize_priority()
                         visualizer.visualize_round_robin()
+                        visualizer.compare_policies()
+                    elif admin_choice == '7':
+                        path = input("Enter file path: ").strip()
+                        try:
+                            report = donor_system.bulk_import(path)
+                        except OSError as e:
+                            print(Fore.RED + f"❌ Cannot read {path}: {e}" + Style.RESET_ALL)
+                        else:
+                            print(Fore.GREEN + f"✅ Imported {report['imported']} of {report['read']} donors in {report['elapsed']:.1f}s ({report['per_second']:.0f} records/s), {report['duplicates']} duplicates." + Style.RESET_ALL)
+                            if report['errors']:
+                                print(tabulate(report['errors'][:20], headers=["Line", "Error"], tablefmt="grid"))
+                    elif admin_choice == '8':
+                        action = input("Filter by action (blank for all): ").strip() or None
+                        hours = input("Last how many hours (blank for all): ").strip()
+                        try:
+                            start = time.time() - float(hours) * 3600 if hours else None
+                        except ValueError:
+                            print(Fore.RED + "❌ Hours must be a number!" + Style.RESET_ALL)
+                        else:
+                            events = deque(audit.query(start=start, action=action), maxlen=20)
+                            table = [[datetime.fromtimestamp(e.timestamp).strftime("%Y-%m-%d %H:%M:%S"), e.action, e.actor or "-", e.details]
+                                     for e in events]
+                            print(tabulate(table, headers=["Time", "Action", "Actor", "Details"], tablefmt="grid"))
+                    elif admin_choice == '9':
+                        scheduler.process_batch()
+                    elif admin_choice == '10':
+                        if metrics is None:
+                            metrics = instrument_bank(Metrics(profiler=SamplingProfiler()), inventory, scheduler)
+                            print(Fore.YELLOW + "Metrics enabled; counts start from now." + Style.RESET_ALL)
+                        print(json.dumps(metrics.snapshot(), indent=2, default=str))
                     else:
                         print(Fore.RED + "❌ Invalid choice!" + Style.RESET_ALL)
             else:
                 print(Fore.RED + "❌ Invalid credentials!" + Style.RESET_ALL)
         elif choice == '6':
             print(Fore.YELLOW + "Exiting..." + Style.RESET_ALL)
+            store.close()
             break
         else:
             print(Fore.RED + "❌ Invalid choice!" + Style.RESET_ALL)
 
         input(Fore.YELLOW + "\nPress Enter to continue..." + Style.RESET_ALL)
 
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Blood Bank Management System. Runs the interactive menu when no command is given.")
+    commands = parser.add_subparsers(dest='command')
+    replay_parser = commands.add_parser('replay', help="Replay a JSONL event file headlessly")
+    replay_parser.add_argument('events', help="Event file, or - for stdin")
+    replay_parser.add_argument('-o', '--output', default='-', help="Result records (JSONL), default stdout")
+    replay_parser.add_argument('--capacity', type=int, default=1000, help="Storage capacity in units")
+    replay_parser.add_argument('--time-quantum', type=int, default=10)
+    replay_parser.add_argument('--aging-rate', type=float, default=0)
+    serve_parser = commands.add_parser('serve', help="Run the asyncio service on a local socket")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--capacity', type=int, default=100000, help="Storage capacity in units")
+    serve_parser.add_argument('--regions', type=int, default=8, help="Independently locked allocator regions")
+    serve_parser.add_argument('--batch-interval', type=float, default=0.005, help="Seconds between scheduler batches")
+    serve_parser.add_argument('--metrics-port', type=int, help="Expose Prometheus metrics on this port (off by default)")
+    serve_parser.add_argument('--event-log', help="Append engine events to this JSONL file (off by default)")
+    serve_parser.add_argument('--state-dir', help="Keep stock and queue in this directory across restarts (off by default)")
+    # The menu's options get their own dests, or serve's defaults would
+    # overwrite them; given before a command they would do nothing, so
+    # that is an error
+    parser.add_argument('--state-dir', dest='menu_state_dir', metavar='STATE_DIR', help="Where the interactive menu keeps stock and queue (default bank_state)")
+    parser.add_argument('--metrics-port', dest='menu_metrics_port', metavar='METRICS_PORT', type=int, help="Expose Prometheus metrics for the interactive menu on this port")
+    args = parser.parse_args(argv)
+    if args.command and (args.menu_state_dir is not None or args.menu_metrics_port is not None):
+        parser.error(f"--state-dir and --metrics-port before a command only apply to the interactive menu; "
+                     f"give them after '{args.command}' where it supports them")
+
+    if args.command == 'serve':
+        serve(args.host, args.port, args.capacity, args.regions, args.batch_interval, args.metrics_port, args.event_log, args.state_dir)
+    elif args.command == 'replay':
+        summary = replay(args.events, args.output, args.capacity, args.time_quantum, args.aging_rate)
+        print(json.dumps(summary), file=sys.stderr)
+    else:
+        main(args.menu_metrics_port, args.menu_state_dir or 'bank_state')
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    cli()
\ No newline at end of file
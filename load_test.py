@@ -0,0 +1,104 @@
+# Load test for the asyncio service front-end
+# Starts `blood_bank_1.py serve` in a subprocess, then drives it with 1, 2, 4,
+# ... concurrent clients, each sending a seeded mix of donations and requests
+# over its own connection, and reports throughput per concurrency level:
+#   python load_test.py --clients 1,2,4,8,16,32 --ops 500
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+from tabulate import tabulate
+
+BLOOD_TYPES = ['A+', 'A-', 'B+', 'B-', 'AB+', 'AB-', 'O+', 'O-']
+
+async def client(host, port, ops, seed, latencies):
+    rng = random.Random(seed)
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for i in range(ops):
+            if i % 2 == 0:
+                message = {'op': 'donate', 'blood_type': rng.choice(BLOOD_TYPES), 'units': rng.randint(1, 10)}
+            else:
+                message = {'op': 'request', 'blood_type': rng.choice(BLOOD_TYPES),
+                           'units': rng.randint(1, 10), 'priority': rng.randint(1, 10)}
+            start = time.perf_counter()
+            writer.write(json.dumps(message).encode() + b'\n')
+            await writer.drain()
+            reply = json.loads(await reader.readline())
+            latencies.append(time.perf_counter() - start)
+            if 'error' in reply:
+                raise RuntimeError(reply['error'])
+    finally:
+        writer.close()
+
+async def run_level(host, port, clients, ops, seed):
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(client(host, port, ops, seed + i, latencies) for i in range(clients)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'clients': clients,
+        'ops': clients * ops,
+        'seconds': elapsed,
+        'ops_per_sec': clients * ops / elapsed,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+async def wait_for_port(host, port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+async def main_async(args):
+    await wait_for_port(args.host, args.port)
+    results = []
+    for clients in [int(c) for c in args.clients.split(',')]:
+        results.append(await run_level(args.host, args.port, clients, args.ops, args.seed))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the blood bank service")
+    parser.add_argument('--clients', default='1,2,4,8,16,32', help="Comma-separated concurrency levels")
+    parser.add_argument('--ops', type=int, default=500, help="Operations per client")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--external', action='store_true', help="Use an already running server")
+    parser.add_argument('-o', '--output', help="Write results as JSON")
+    args = parser.parse_args(argv)
+
+    server = None
+    if not args.external:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blood_bank_1.py')
+        server = subprocess.Popen([sys.executable, script, 'serve', '--host', args.host, '--port', str(args.port),
+                                   '--capacity', '10000000'])
+    try:
+        results = asyncio.run(main_async(args))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    print(tabulate([[r['clients'], r['ops'], f"{r['seconds']:.2f}", f"{r['ops_per_sec']:,.0f}",
+                     f"{r['p50_ms']:.2f}", f"{r['p99_ms']:.2f}"] for r in results],
+                   headers=["Clients", "Ops", "Seconds", "Ops/s", "p50 ms", "p99 ms"], tablefmt="grid"))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+import asyncio
+import io
+import itertools
+import json
+import multiprocessing
+import random
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+import blood_bank_1
+from blood_bank_1 import BLOOD_TYPES, BankersAlgorithm, BloodBankService, BloodInventory, ConsoleSink, MemoryManager, Metrics, PersistentStore, Scheduler, ShardRouter, StorageRegion, Visualizer, allocate_batch, instrument_bank, plan_transfers, quiet, size_class, replay, use_sink
+
+
+def test_allocate_batch_serves_smaller_requests_behind_one_that_does_not_fit():
+    # A+ is code 0; both requests share a priority level
+    served, drawn = allocate_batch([100, 1], [0, 0], [5, 5], [50, 0, 0, 0, 0, 0, 0, 0])
+    assert served.tolist() == [False, True]
+    assert drawn.sum() == 1
+
+
+def test_process_batch_matches_priority_on_oversized_head_request():
+    with quiet():
+        inventory = BloodInventory(MemoryManager(1000))
+        inventory.donate_blood('A+', 50)
+        scheduler = Scheduler(inventory)
+        scheduler.add_request({'id': 1, 'blood_type': 'A+', 'units': 100, 'priority': 5})
+        scheduler.add_request({'id': 2, 'blood_type': 'A+', 'units': 1, 'priority': 5})
+        result = scheduler.process_batch()
+    assert [pid for pid, _, _ in result['processed']] == [2]
+    assert [req['id'] for req in result['blocked']] == [1]
+    assert inventory.blood_stock['A+']['units'] == 49
+
+
+def test_add_request_rejects_unknown_type_and_non_positive_units():
+    with quiet():
+        scheduler = Scheduler(BloodInventory(MemoryManager(1000)))
+        assert not scheduler.add_request({'id': 1, 'blood_type': 'Z', 'units': 5, 'priority': 5})
+        assert not scheduler.add_request({'id': 2, 'blood_type': 'A+', 'units': 0, 'priority': 5})
+        assert scheduler.add_request({'id': 3, 'blood_type': 'A+', 'units': 5, 'priority': 5})
+    assert [req['id'] for req in scheduler.requests] == [3]
+
+
+def test_bankers_from_requests_skips_unknown_types():
+    requests = [{'id': 1, 'blood_type': 'Z', 'units': 5}, {'id': 2, 'blood_type': 'A+', 'units': 5}]
+    bankers = BankersAlgorithm.from_requests([10] * len(BLOOD_TYPES), BLOOD_TYPES, requests)
+    assert bankers.processes == [2]
+
+
+def test_replay_reports_bad_lines_and_keeps_going(tmp_path):
+    events = tmp_path / 'events.jsonl'
+    events.write_text('{"op": "donate", "blood_type": "A+", "units": 5}\n'
+                      '{"op": "donate", "blood_ty\n'
+                      '[1, 2]\n'
+                      '{"op": "donate", "time": "yesterday", "blood_type": "A+", "units": 5}\n'
+                      '{"op": "dispense", "blood_type": "A+", "units": 2}\n')
+    output = tmp_path / 'out.jsonl'
+    summary = replay(str(events), str(output))
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [record['ok'] for record in records] == [True, False, False, False, True]
+    assert summary['failed'] == 3 and summary['stock']['A+'] == 3
+    assert not isinstance(blood_bank_1.SINK, blood_bank_1.NullSink)
+
+
+def test_console_sink_keeps_only_the_rows_it_shows():
+    out = io.StringIO()
+    with use_sink(ConsoleSink(max_rows=2, file=out)) as sink:
+        inventory = BloodInventory(MemoryManager(1000))
+        inventory.donate_blood('A+', 100)
+        scheduler = Scheduler(inventory, time_quantum=1)
+        for request_id in range(1, 6):
+            scheduler.add_request({'id': request_id, 'blood_type': 'A+', 'units': 3, 'priority': 5})
+        scheduler.process_round_robin()
+        assert len(sink.slices) == 0
+    assert "... and 13 more" in out.getvalue()
+
+
+def crash(store):
+    # Stops the store the way a crash would: whatever reached the log stays,
+    # no final checkpoint is written
+    store.stopped.set()
+    store.wal.close()
+
+
+def test_checkpoint_waits_for_an_allocation_that_has_taken_its_space(tmp_path, monkeypatch):
+    store = PersistentStore(str(tmp_path))
+    with quiet():
+        inventory, _ = store.open(1000)
+    take = StorageRegion.take
+    checkpointer = []
+
+    def take_then_checkpoint(region, units):
+        offset = take(region, units)
+        checkpointer.append(threading.Thread(target=store.checkpoint))
+        checkpointer[0].start()
+        checkpointer[0].join(0.05)
+        return offset
+
+    monkeypatch.setattr(StorageRegion, 'take', take_then_checkpoint)
+    inventory.memory_manager.allocate_block('A+', 10)
+    monkeypatch.setattr(StorageRegion, 'take', take)
+    checkpointer[0].join()
+    crash(store)
+    with quiet():
+        inventory, _ = PersistentStore(str(tmp_path)).open(1000)
+    assert inventory.blood_stock['A+']['units'] == 10
+    assert inventory.memory_manager.used_space == 10
+
+
+def test_checkpoint_keeps_log_records_written_while_it_ran(tmp_path, monkeypatch):
+    store = PersistentStore(str(tmp_path))
+    with quiet():
+        _, scheduler = store.open(1000)
+    write_snapshot = blood_bank_1.write_snapshot
+    issued = []
+
+    def issue_during_snapshot(*args):
+        write_snapshot(*args)
+        # Ids are issued under the id lock only, and the writer thread may
+        # have synced them before the log is truncated
+        issued.append(scheduler.next_request_id())
+        store.wal.sync()
+
+    monkeypatch.setattr(blood_bank_1, 'write_snapshot', issue_during_snapshot)
+    store.checkpoint()
+    crash(store)
+    with quiet():
+        _, scheduler = PersistentStore(str(tmp_path)).open(1000)
+    assert scheduler.next_request_id() > issued[0]
+
+
+def test_store_recovers_its_layout_after_a_crash_before_any_checkpoint(tmp_path):
+    store = PersistentStore(str(tmp_path))
+    with quiet():
+        inventory, scheduler = store.open(total_capacity=5000, regions=4)
+        for bt in BLOOD_TYPES:
+            inventory.donate_blood(bt, 30)
+        inventory.request_blood('A+', 12)
+        scheduler.add_request({'id': scheduler.next_request_id(), 'blood_type': 'O-', 'units': 5, 'priority': 3})
+    crash(store)
+    with quiet():
+        inventory, scheduler = PersistentStore(str(tmp_path)).open()
+    memory_manager = inventory.memory_manager
+    assert (memory_manager.total_capacity, len(memory_manager.regions)) == (5000, 4)
+    assert inventory.blood_stock['A+']['units'] == 18 and inventory.blood_stock['O-']['units'] == 30
+    assert [req['units'] for req in scheduler.requests] == [5]
+    assert scheduler.next_request_id() == 2
+
+
+def test_store_replays_the_log_written_after_a_checkpoint(tmp_path):
+    store = PersistentStore(str(tmp_path))
+    with quiet():
+        inventory, scheduler = store.open(1000, regions=2)
+        inventory.donate_blood('B+', 40)
+        scheduler.add_request({'id': scheduler.next_request_id(), 'blood_type': 'B+', 'units': 10, 'priority': 5})
+        store.checkpoint()
+        inventory.donate_blood('B+', 5)
+        scheduler.process_priority()
+    crash(store)
+    with quiet():
+        inventory, scheduler = PersistentStore(str(tmp_path)).open()
+    assert inventory.blood_stock['B+']['units'] == 35
+    assert inventory.memory_manager.used_space == 35
+    assert len(scheduler.requests) == 0 and scheduler.next_request_id() == 2
+
+
+def test_store_recovers_writes_that_raced_with_checkpoints(tmp_path):
+    store = PersistentStore(str(tmp_path))
+    with quiet():
+        inventory, scheduler = store.open(100000, regions=8)
+    done = threading.Event()
+
+    def checkpoints():
+        while not done.is_set():
+            store.checkpoint()
+
+    def writer(bt):
+        for _ in range(200):
+            inventory.donate_blood(bt, 3)
+            inventory.request_blood(bt, 1, substitute=False)
+            scheduler.next_request_id()
+
+    checkpointer = threading.Thread(target=checkpoints)
+    writers = [threading.Thread(target=writer, args=(bt,)) for bt in BLOOD_TYPES]
+    with quiet():
+        checkpointer.start()
+        for thread in writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        checkpointer.join()
+    crash(store)
+    with quiet():
+        inventory, scheduler = PersistentStore(str(tmp_path)).open()
+    assert all(inventory.blood_stock[bt]['units'] == 400 for bt in BLOOD_TYPES)
+    assert inventory.memory_manager.used_space == 400 * len(BLOOD_TYPES)
+    assert scheduler.next_request_id() == 200 * len(BLOOD_TYPES) + 1
+
+
+def test_transfer_returns_lots_the_destination_has_no_room_for():
+    router = ShardRouter(['north', 'south'], total_capacity=100)
+    try:
+        router.donate('north', 'B+', 100)
+        router.donate('south', 'A+', 15)
+        assert router.transfer([('south', 'north', 'A+', 15)]) == []
+        stock = router.stock()
+    finally:
+        router.close()
+    assert stock['north']['A+'] == 0 and stock['south']['A+'] == 15
+
+
+def test_plan_transfers_only_moves_stock_for_requests_it_can_fill():
+    empty = {bt: 0 for bt in BLOOD_TYPES}
+    stock = {'north': dict(empty, **{'A+': 3}), 'south': dict(empty, **{'A+': 15})}
+    assert plan_transfers({'north': {'A+': [20]}}, stock) == []
+    assert plan_transfers({'north': {'A+': [20, 10]}}, stock) == [('south', 'north', 'A+', 7)]
+
+
+def test_shard_router_rejects_invalid_requests():
+    router = ShardRouter(['north', 'south'], total_capacity=100)
+    try:
+        router.donate('south', 'A+', 15)
+        with quiet():
+            assert router.add_request('north', {'blood_type': 'Z', 'units': 5}) is None
+            assert router.add_request('north', {'blood_type': 'A+', 'units': 0}) is None
+        router.add_request('north', {'blood_type': 'A+', 'units': 18})
+        result = router.process()
+    finally:
+        router.close()
+    assert result['transfers'] == []
+    assert result['sites']['north']['blocked'] == 1
+
+
+def test_service_replies_to_bad_requests_and_keeps_serving(monkeypatch):
+    inventory = BloodInventory(MemoryManager(1000))
+    service = BloodBankService(inventory, Scheduler(inventory), batch_interval=0.001)
+
+    async def run():
+        service.batcher = asyncio.create_task(service.batch_loop())
+        try:
+            await service.dispatch({'op': 'donate', 'blood_type': 'A+', 'units': 10})
+            too_many = await service.dispatch({'op': 'request', 'blood_type': 'A+', 'units': 1e20})
+            bad_priority = await service.dispatch({'op': 'request', 'blood_type': 'A+', 'units': 1, 'priority': 2 ** 70})
+            with monkeypatch.context() as patch:
+                patch.setattr(service.scheduler, 'process_batch', lambda: 1 / 0)
+                broken = await asyncio.wait_for(service.dispatch({'op': 'request', 'blood_type': 'A+', 'units': 1}), 1)
+            served = await asyncio.wait_for(service.dispatch({'op': 'request', 'blood_type': 'A+', 'units': 2}), 1)
+        finally:
+            service.batcher.cancel()
+            service.executor.shutdown()
+        return too_many, bad_priority, broken, served
+
+    with quiet():
+        too_many, bad_priority, broken, served = asyncio.run(run())
+    assert not too_many['ok'] and not bad_priority['ok']
+    assert broken == {'ok': False, 'error': "ZeroDivisionError: division by zero"}
+    assert served['status'] == 'served' and len(service.scheduler.requests) == 0
+
+
+def test_process_batch_serves_other_types_when_one_request_cannot_be_filled():
+    with quiet():
+        inventory = BloodInventory(MemoryManager(1000))
+        inventory.donate_blood('O-', 50)
+        scheduler = Scheduler(inventory)
+        scheduler.add_request({'id': 1, 'blood_type': 'A+', 'units': 100, 'priority': 5})
+        scheduler.add_request({'id': 2, 'blood_type': 'B+', 'units': 40, 'priority': 5})
+        result = scheduler.process_batch()
+    assert [pid for pid, _, _ in result['processed']] == [2]
+    assert inventory.blood_stock['O-']['units'] == 10
+
+
+def test_allocate_batch_serves_a_request_when_the_flow_is_split_across_types(monkeypatch):
+    # 50 O- can fill 30 A+ or 40 B+ but not both; a flow split 25/25 fills neither
+    split = [[0] * len(BLOOD_TYPES) for _ in BLOOD_TYPES]
+    split[7][0] = split[7][2] = 25
+    solve = blood_bank_1.min_cost_transport
+    monkeypatch.setattr(blood_bank_1, 'min_cost_transport', lambda supply, demand: split if supply[7] == 50 else solve(supply, demand))
+    served, drawn = allocate_batch([30, 40], [0, 2], [5, 5], [0, 0, 0, 0, 0, 0, 0, 50])
+    assert served.tolist() == [True, False]
+    assert drawn[7, 0] == 30 and drawn.sum() == 30
+
+
+def test_instrument_bank_times_the_allocator_calls_the_inventory_makes():
+    inventory = BloodInventory(MemoryManager(1000))
+    scheduler = Scheduler(inventory)
+    metrics = instrument_bank(Metrics(), inventory, scheduler)
+    with quiet():
+        inventory.donate_blood('A+', 10)
+        inventory.request_blood('A+', 3)
+        scheduler.add_request({'id': 1, 'blood_type': 'A+', 'units': 2, 'priority': 5})
+        scheduler.process_priority()
+    metrics.restore()
+    latency = metrics.snapshot()['latency_seconds']
+    assert latency['allocate_block']['count'] == 1
+    assert latency['_deallocate']['count'] == 2
+
+
+def test_cli_keeps_serve_options_apart_from_the_menu_options(monkeypatch):
+    calls = []
+    monkeypatch.setattr(blood_bank_1, 'serve', lambda *args: calls.append(args))
+    blood_bank_1.cli(['serve', '--state-dir', 'state', '--metrics-port', '9100'])
+    assert calls[0][5] == 9100 and calls[0][7] == 'state'
+    with pytest.raises(SystemExit):
+        blood_bank_1.cli(['--state-dir', 'state', 'serve'])
+
+
+def test_simulate_does_not_count_spoiled_lots_as_dispensed():
+    now = [datetime.now()]
+    with quiet():
+        inventory = BloodInventory(MemoryManager(1000), clock=lambda: now[0])
+        inventory.donate_blood('A+', 10)
+        inventory.donate_blood('A+', 5, expiry_date=now[0] + timedelta(days=1))
+        now[0] += timedelta(days=2)
+        scheduler = Scheduler(inventory)
+        scheduler.add_request({'id': 1, 'blood_type': 'A+', 'units': 4, 'priority': 5})
+    result = Visualizer(inventory, scheduler, BLOOD_TYPES).simulate('priority')
+    assert result['dispensed']['A+'] == 4 and result['stock']['A+'] == 6
+
+
+def test_simulate_with_metrics_leaves_the_live_allocator_alone():
+    with quiet():
+        inventory = BloodInventory(MemoryManager(1000))
+        inventory.donate_blood('A+', 10)
+        scheduler = Scheduler(inventory)
+        scheduler.add_request({'id': 1, 'blood_type': 'A+', 'units': 4, 'priority': 5})
+    metrics = instrument_bank(Metrics(), inventory, scheduler)
+    try:
+        result = Visualizer(inventory, scheduler, BLOOD_TYPES).simulate('priority')
+    finally:
+        metrics.restore()
+    assert result['stock']['A+'] == 6
+    assert inventory.blood_stock['A+']['units'] == 10
+    assert inventory.memory_manager.used_by_type['A+'] == 10
+
+
+def test_donate_rejects_blood_that_has_already_expired():
+    with quiet():
+        inventory = BloodInventory(MemoryManager(1000))
+        assert not inventory.donate_blood('A+', 5, expiry_date=datetime.now() - timedelta(seconds=1))
+    assert inventory.blood_stock['A+']['units'] == 0
+
+
+def test_transfer_ships_the_expiry_of_lots_that_are_still_good(monkeypatch):
+    now = [datetime.now()]
+    parent, child = multiprocessing.Pipe()
+    # The site builds its own inventory; run it in a thread on a fake clock
+    monkeypatch.setattr(blood_bank_1, 'BloodInventory', lambda mm: BloodInventory(mm, clock=lambda: now[0]))
+    monkeypatch.setattr(blood_bank_1, 'SINK', blood_bank_1.SINK)
+    worker = threading.Thread(target=blood_bank_1.site_worker, args=(child, 1000, 1, 10))
+    worker.start()
+    try:
+        parent.send(('transfer_in', [('A+', 5, now[0] + timedelta(seconds=1)), ('A+', 20, now[0] + timedelta(days=30))]))
+        assert parent.recv() == [True, True]
+        now[0] += timedelta(seconds=2)
+        parent.send(('transfer_out', [('A+', 10)]))
+        ((token, lot),) = parent.recv()
+        parent.send(('transfer_settle', [(token, False)]))
+        assert parent.recv() == [True]
+    finally:
+        parent.send(('close', None))
+        worker.join()
+    assert lot[2] > now[0]
+
+
+def test_storage_region_takes_the_smallest_segment_of_the_first_size_class_that_fits():
+    rng = random.Random(7)
+    region = StorageRegion(0, 5000)
+    taken = {}
+    for _ in range(5000):
+        if taken and rng.random() < 0.45:
+            offset = rng.choice(list(taken))
+            region.release(offset, taken.pop(offset))
+            continue
+        units = rng.randint(1, 80)
+        free = dict(region.free_by_start)
+        fitting = [size for size in free.values() if size >= units]
+        offset = region.take(units)
+        if not fitting:
+            assert offset is None
+            continue
+        # The request's own class is used when its smallest segment fits,
+        # which is then the best fit; otherwise the next class that has one
+        own = [size for size in free.values() if size_class(size) == size_class(units)]
+        if own and min(own) >= units:
+            assert free[offset] == min(fitting)
+        elif any(size_class(size) > size_class(units) for size in fitting):
+            assert free[offset] == min(size for size in fitting if size_class(size) > size_class(units))
+        else:
+            assert free[offset] == min(fitting)
+        taken[offset] = units
+    # Free segments and allocations tile the region without overlapping
+    spans = sorted(list(region.free_by_start.items()) + list(taken.items()))
+    assert [offset for offset, _ in spans] == [0] + list(itertools.accumulate(size for _, size in spans))[:-1]
+    assert region.used == sum(taken.values())
+
+
+def test_reserved_units_are_held_until_committed_or_cancelled():
+    with quiet():
+        inventory = BloodInventory(MemoryManager(1000))
+        inventory.donate_blood('A+', 10)
+        token = inventory.reserve('A+', 8)
+        assert not inventory.request_blood('A+', 5, substitute=False)
+        assert inventory.reserve('A+', 3) is None
+        assert inventory.commit(token)
+        assert not inventory.commit(token) and not inventory.cancel(token)
+        assert inventory.blood_stock['A+']['units'] == 2
+        token = inventory.reserve('A+', 2)
+        assert inventory.cancel(token)
+        assert inventory.request_blood('A+', 2, substitute=False)